@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the hot paths.
+
+usage: bench.py [-h] {outlet,parser,sections,context}
+"""
+
+import argparse
+import json
+import re
+import timeit
+from urllib.parse import urlparse
+
+
+def bench_outlet(number: int = 10_000):
+    """
+    Outlet lookup cost as the number of registered outlets grows.
+    """
+    from klikinsaastaja_ng.outlet import GenericOutletProvider, OutletRegistry
+
+    print(f"{'outlets':>8} {'cold µs':>10} {'cached µs':>10}")
+    for count in (1, 10, 100, 1000):
+        registry = OutletRegistry()
+        for i in range(count):
+            registry.register(GenericOutletProvider(
+                name=f"Outlet{i}",
+                matching_urls=[
+                    urlparse(f"//www.outlet{i}.fi"),
+                    re.compile(rf"https://m\.outlet{i}\.fi/"),
+                ],
+            ))
+
+        # Worst case: the last registered outlet, matched through the combined pattern
+        url = f"https://m.outlet{count - 1}.fi/uutiset/a/123"
+
+        def cold():
+            registry.lookup.cache_clear()
+            registry.lookup(url)
+
+        cold_time = timeit.timeit(cold, number=number) / number
+        cached_time = timeit.timeit(lambda: registry.lookup(url), number=number) / number
+        print(f"{count:>8} {cold_time * 1e6:>10.2f} {cached_time * 1e6:>10.2f}")
+
+
+def bench_parser(number: int = 1_000):
+    """
+    Bot response parsing, compared to the previous regex split and `json.loads`.
+    """
+    from klikinsaastaja_ng.utils import JsonObjectStream, parse_bot_response
+
+    def legacy(response):
+        return json.loads(re.split(r"```json\n(.*)\n```", response, flags=re.MULTILINE | re.DOTALL)[1])
+
+    groups = [
+        {
+            "lang": "fi",
+            "name": f"Ryhmä {i}",
+            "wikipedia query": f"Ryhmä {i}",
+            "reasoning": "Haastateltu artikkelissa, jolla on taloudellinen intressi aiheeseen. " * 3,
+            "rag query": f"Ryhmä {i} lobbaus",
+        }
+        for i in range(20)
+    ]
+    valid = "Tässä vastaus:\n```json\n" + json.dumps(groups, ensure_ascii=False, indent=4) + "\n```"
+    single_quoted = valid.replace('"', "'").replace("'\n    }", "',\n    }")
+    truncated = single_quoted[: len(single_quoted) * 2 // 3]
+
+    def streamed(response):
+        parser = JsonObjectStream()
+        for i in range(0, len(response), 16):
+            parser.feed(response[i:i + 16])
+        return parser.result()
+
+    print(f"{'response':>14} {'parser':>8} {'µs':>9} {'objects':>8}")
+    for name, response in (("valid", valid), ("single quoted", single_quoted), ("truncated", truncated)):
+        for parser_name, parse in (("legacy", legacy), ("new", parse_bot_response), ("stream", streamed)):
+            try:
+                objects = len(parse(response))
+            except Exception:
+                print(f"{name:>14} {parser_name:>8} {'failed':>9}")
+                continue
+            elapsed = timeit.timeit(lambda: parse(response), number=number) / number
+            print(f"{name:>14} {parser_name:>8} {elapsed * 1e6:>9.1f} {objects:>8}")
+
+
+def _wikitext(sections: int) -> str:
+    """
+    Synthetic Wikipedia page with nested subsections, links and templates.
+    """
+    paragraph = (
+        "The [[Finnish Parliament|parliament]] approved the {{lang|fi|budjetti}} on a vote of 101 to 82, after a "
+        "debate that lasted for '''three days'''.<ref>{{cite web|url=https://example.com|title=Source}}</ref>\n\n"
+    )
+    text = [paragraph * 3]
+    for i in range(sections):
+        text.append(f"== Section {i} ==\n{paragraph * 4}")
+        for j in range(3):
+            text.append(f"=== Subsection {i}.{j} ===\n{paragraph * 2}")
+            for k in range(2):
+                text.append(f"==== Detail {i}.{j}.{k} ====\n{paragraph}")
+    text.append("== References ==\n{{reflist}}\n")
+    return "".join(text)
+
+
+def bench_sections(number: int = 5):
+    """
+    Wikipedia section splitting, compared to the previous recursive splitter.
+    """
+    import mwparserfromhell
+    from wp import WikipediaAPIWrapper
+
+    loader = WikipediaAPIWrapper(lang="en", load_all_available_meta=False)
+
+    def legacy_subsections(section, parent_titles):
+        headings = [str(h) for h in section.filter_headings()]
+        if not headings:
+            return []
+        title = headings[0]
+        cleaned_title = title.strip("=" + " ")
+        if cleaned_title in loader.SECTIONS_TO_IGNORE:
+            return []
+
+        titles = parent_titles + [cleaned_title]
+        section_text = str(section).split(title)[1]
+        if len(headings) == 1:
+            return [(titles, section_text)]
+
+        results = [(titles, section_text.split(headings[1])[0])]
+        for subsection in section.get_sections(levels=[len(titles) + 1]):
+            results.extend(legacy_subsections(subsection, titles))
+        return results
+
+    def legacy(wikicode):
+        return [s for section in wikicode.get_sections(levels=[2]) for s in legacy_subsections(section, ["Page"])]
+
+    print(f"{'sections':>9} {'kB':>6} {'legacy ms':>10} {'new ms':>8} {'speedup':>8} {'same':>5}")
+    for count in (10, 50, 200, 500):
+        wikicode = mwparserfromhell.parse(_wikitext(count))
+        same = legacy(wikicode) == loader._sections(wikicode, "Page")
+
+        legacy_time = timeit.timeit(lambda: legacy(wikicode), number=number) / number
+        new_time = timeit.timeit(lambda: loader._sections(wikicode, "Page"), number=number) / number
+        print(
+            f"{count:>9} {len(str(wikicode)) / 1024:>6.0f} {legacy_time * 1e3:>10.1f} {new_time * 1e3:>8.2f}"
+            f" {legacy_time / new_time:>7.0f}x {str(same):>5}"
+        )
+
+
+def bench_context(number: int = 20):
+    """
+    Context compaction of article shapes, checking that the result fits the token budget.
+    """
+    from klikinsaastaja_ng.context import TRUNCATION_MARKER, compact_context
+
+    max_tokens = 300
+    articles = {
+        "lead + one body": "Lyhyt ingressi.\n\n" + "sana " * 5000,
+        "one paragraph": "sana " * 5000,
+        "many paragraphs": "\n\n".join(f"Kappale {i}. " + "sana " * 40 for i in range(100)),
+        "lead + body + end": "Ingressi.\n\n" + "sana " * 3000 + "\n\nLopetus.",
+        "fits": "Ingressi.\n\nLyhyt kappale.",
+    }
+
+    print(f"{'article':>18} {'before':>7} {'after':>6} {'marker':>7} {'ms':>7}")
+    for name, markdown in articles.items():
+        context = compact_context(markdown, max_tokens=max_tokens)
+        assert context.tokens_after <= max_tokens, f"{name}: {context.tokens_after} tokens > {max_tokens}"
+        # Truncated articles keep most of their budget, instead of just the lead
+        assert context.tokens_after > max_tokens // 2 or context.tokens_before <= max_tokens, name
+
+        elapsed = timeit.timeit(lambda: compact_context(markdown, max_tokens=max_tokens), number=number) / number
+        print(
+            f"{name:>18} {context.tokens_before:>7} {context.tokens_after:>6}"
+            f" {str(TRUNCATION_MARKER in context.text):>7} {elapsed * 1e3:>7.2f}"
+        )
+
+
+BENCHMARKS = {
+    "outlet": bench_outlet,
+    "parser": bench_parser,
+    "sections": bench_sections,
+    "context": bench_context,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run micro-benchmarks")
+    parser.add_argument("benchmark", choices=BENCHMARKS.keys(), nargs="*", help="Benchmarks to run. Default: all")
+    args = parser.parse_args()
+
+    for name in args.benchmark or BENCHMARKS:
+        print(f"# {name}")
+        BENCHMARKS[name]()
@@ -14,19 +14,20 @@ import json
 import os
 import random
 import re
-from typing import Dict, List, NamedTuple, Union
-import newspaper
-from playwright.sync_api import Browser, sync_playwright, TimeoutError
+import signal
+from typing import Dict, Iterable, List, NamedTuple, Set, Union
+from playwright.sync_api import sync_playwright
 
-import requests
 
 from jinja2 import Template
 
-from sqlalchemy import Column, Integer, String, Text, Float
+from sqlalchemy import Column, ForeignKey, Integer, LargeBinary, String, Text, Float
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.types import DateTime
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, delete, event, insert, inspect, select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, deferred, relationship, scoped_session, selectinload, sessionmaker, undefer
+from sqlalchemy.orm.exc import DetachedInstanceError
 from sqlalchemy_utils import database_exists, create_database
 
 from markdownify import markdownify as md
@@ -34,6 +35,8 @@ from markdownify import markdownify as md
 from datetime import datetime
 import logging
 import contextvars
+from contextlib import contextmanager
+import threading
 from dotenv import load_dotenv
 
 from platformdirs import user_data_dir
@@ -93,11 +96,32 @@ except ImportError:
 logger = logging.getLogger(__name__)
 
 edgetgpt_bot = contextvars.ContextVar(f"{__name__}_edgetgpt_bot")
-db_session = contextvars.ContextVar(f"{__name__}_db_session")
 
 BaseModel = declarative_base()
 
 from klikinsaastaja_ng.models import Href  # noqa: E402
+from klikinsaastaja_ng.settings import settings  # noqa: E402
+from klikinsaastaja_ng.outlets.iltalehti import IltalehtiFeed, fetch_latest_iltalehti  # noqa: E402
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Store article contexts zstd compressed in a side table, when zstandard is installed
+COMPRESS_CONTEXT = zstandard is not None and settings.compress_context
+
+
+class HrefContextModel(BaseModel):
+    """
+    Compressed article context, kept out of the `hrefs` table.
+    """
+
+    __tablename__ = 'href_contexts'
+
+    href_id: int = Column(Integer, ForeignKey('hrefs.id', ondelete="CASCADE"), primary_key=True)
+    data: bytes = Column(LargeBinary, nullable=False)  # zstd compressed UTF-8 markdown
+
 
 class HrefModel(BaseModel):
     """
@@ -111,17 +135,30 @@ class HrefModel(BaseModel):
     title: str = Column(String(255))  # Title of the article
     original_url: str = Column(String(255), index=True)  # URL to which the article is redirected
     original_title: str = Column(String(255))  # Original title of the article
-    context: str = Column(Text)  # Content of the article
+    # Heavy columns are loaded only when accessed
+    _context = deferred(Column(Text, name="context"))  # Content of the article, if not compressed
+    _compressed_context = relationship(HrefContextModel, uselist=False, cascade="all, delete-orphan")
 
-    _reasoning: str = Column(Text, name="reasoning")  # Reasoning for the title as a list
+    _reasoning = deferred(Column(Text, name="reasoning"))  # Reasoning for the title as a list
     sensationalism: float = Column(Float)  # Sensationalism score of the original title
 
     created = Column(DateTime, default=datetime.utcnow)  # Date and time when the article was created
     modified = Column(DateTime, onupdate=datetime.utcnow)  # Date and time when the article was last modified
     published = Column(DateTime)  # Date and time when the article was published
 
+    def _require_text(self, *keys: str):
+        """
+        Raise a clear error if the text columns `keys` weren't loaded, and can't be loaded lazily anymore.
+        """
+        state = inspect(self)
+        if state.detached and not state.unloaded.isdisjoint(keys):
+            raise DetachedInstanceError(
+                f"Text of {self!r} isn't loaded, fetch it with load_text=True to access the context and reasoning"
+            )
+
     @property
     def reasoning(self):
+        self._require_text("_reasoning")
         if self._reasoning is None:
             return None
         return json.loads(self._reasoning)
@@ -130,19 +167,75 @@ class HrefModel(BaseModel):
     def reasoning(self, value):
         self._reasoning = json.dumps(value)
 
+    @property
+    def context(self):
+        self._require_text("_context", "_compressed_context")
+        if self._compressed_context is not None:
+            return zstandard.decompress(self._compressed_context.data).decode("utf-8")
+        return self._context
+
+    @context.setter
+    def context(self, value):
+        if COMPRESS_CONTEXT and value is not None:
+            self._compressed_context = HrefContextModel(data=zstandard.compress(value.encode("utf-8")))
+            self._context = None
+        else:
+            self._compressed_context = None
+            self._context = value
+
     def __repr__(self):
         """
         Returns a string representation of the Article object.
         """
-        return f"<Article(url={self.url!r}, title={self.title!r}, reasoning={self.reasoning!r})>"
+        return f"<Article(url={self.url!r}, title={self.title!r}, sensationalism={self.sensationalism!r})>"
+
+
+# Pragmas for every SQLite connection
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",  # Readers don't block the writer
+    "synchronous": "NORMAL",  # Durable enough with WAL, and avoids a fsync per commit
+    "busy_timeout": 5000,  # Wait for locks instead of failing with "database is locked"
+    "cache_size": -16000,  # 16 MB page cache
+    "temp_store": "MEMORY",
+    "foreign_keys": "ON",  # Enforce foreign keys, so deleting an article deletes its compressed context
+}
+
+# Rows per INSERT or UPDATE statement, and URLs per IN query
+BATCH_SIZE = 500
 
 
-def get_db_session():
-    session = db_session.get(None)
-    if session is None:
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+
+_engine: Engine | None = None
+_engine_lock = threading.Lock()
+
+# Thread-local sessions, removed after each unit of work. Objects stay usable after commit, so results can be
+# returned from a unit of work.
+db_session = scoped_session(sessionmaker(expire_on_commit=False))
+
+
+def get_engine() -> Engine:
+    """
+    Shared engine. The database and the schema are set up on the first call.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            return _engine
+
         fallback_path = Path(appdata_dir, "hrefs.db")
         db_url = os.environ.get("DATABASE_URL", f"sqlite+pysqlite:///{fallback_path}")
-        engine = create_engine(db_url, connect_args={"check_same_thread": False})
+        if db_url.startswith("sqlite"):
+            # Pooled connections are handed between threads, but used by one thread at a time
+            engine = create_engine(db_url, connect_args={"check_same_thread": False})
+            event.listen(engine, "connect", _set_sqlite_pragmas)
+        else:
+            engine = create_engine(db_url, pool_pre_ping=True)
 
         if not database_exists(engine.url):
             logger.debug("Creating new database with url %r", db_url)
@@ -152,32 +245,145 @@ def get_db_session():
 
         BaseModel.metadata.create_all(engine)
 
-        Session = sessionmaker(bind=engine)
-        session = Session()
+        db_session.configure(bind=engine)
+        _engine = engine
+        return _engine
+
+
+def get_db_session() -> Session:
+    """
+    Session of the current thread.
+    """
+    get_engine()
+    return db_session()
+
 
-        db_session.set(session)
-    return session
+@contextmanager
+def unit_of_work():
+    """
+    Session for a block of work, committed when the block exits and rolled back on errors.
 
+    The session is removed afterwards, so the next unit of work doesn't see stale objects from its identity map.
+    """
+    session = get_db_session()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        db_session.remove()
 
-def fetch_latest_iltalehti() -> List[Href]:
-    latest_url = r"https://api.il.fi/v1/articles/iltalehti/lists/latest?limit=30&image_sizes[]=size138"
-    base_url = r"https://www.iltalehti.fi/{category[category_name]}/a/{article_id}"
 
-    response = requests.get(latest_url)
-    data = response.json()
+def _batches(items: List, size: int = BATCH_SIZE) -> Iterable[List]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
-    article_links = []
 
-    for article in data["response"]:
-        # Skip content that has sponsored content metadata
-        if article.get('metadata', {}).get('sponsored_content', False):
-            logger.debug("Skipping sponsored content: %r", article['title'])
-            continue
+def stored_urls(urls: Iterable[str]) -> Set[str]:
+    """
+    Return which of the `urls` are already stored, with one query per `BATCH_SIZE` URLs.
+    """
+    urls = list(dict.fromkeys(urls))
 
-        url = base_url.format(**article)
-        article_links.append(Href(url, article['title']))
+    stored = set()
+    with unit_of_work() as session:
+        for batch in _batches(urls):
+            stored.update(session.scalars(select(HrefModel.original_url).where(HrefModel.original_url.in_(batch))))
+    return stored
 
-    return article_links
+
+def get_hrefs(urls: Iterable[str], load_text: bool = False) -> Dict[str, HrefModel]:
+    """
+    Fetch stored articles by their original URL.
+
+    :param load_text: Load the context and reasoning in the same query. By default they are not loaded, and can't be
+        accessed on the returned articles.
+    """
+    urls = list(dict.fromkeys(urls))
+
+    options = []
+    if load_text:
+        options = [
+            undefer(HrefModel._context),
+            undefer(HrefModel._reasoning),
+            selectinload(HrefModel._compressed_context),
+        ]
+
+    hrefs = {}
+    with unit_of_work() as session:
+        for batch in _batches(urls):
+            query = select(HrefModel).where(HrefModel.original_url.in_(batch)).order_by(HrefModel.id).options(*options)
+            for href in session.scalars(query):
+                hrefs.setdefault(href.original_url, href)
+    return hrefs
+
+
+def save_hrefs(articles: Iterable[HrefModel]):
+    """
+    Insert new articles and update already stored ones, matched by `original_url`, in a single transaction.
+    """
+    columns = [attr.key for attr in inspect(HrefModel).column_attrs if attr.key not in ("id", "created", "modified")]
+    rows, compressed = {}, {}
+    for article in articles:
+        rows[article.original_url] = {key: getattr(article, key) for key in columns}
+        if article._compressed_context is not None:
+            compressed[article.original_url] = article._compressed_context.data
+    if not rows:
+        return
+
+    with unit_of_work() as session:
+        existing = {}
+        for batch in _batches(list(rows)):
+            query = select(HrefModel.original_url, HrefModel.id).where(HrefModel.original_url.in_(batch))
+            existing.update(session.execute(query).all())
+
+        new = [row for url, row in rows.items() if url not in existing]
+        changed = [{**row, "id": existing[url]} for url, row in rows.items() if url in existing]
+        for batch in _batches(new):
+            inserted = session.execute(insert(HrefModel).returning(HrefModel.original_url, HrefModel.id), batch)
+            existing.update(inserted.all())
+        for batch in _batches(changed):
+            session.execute(update(HrefModel), batch)
+
+        # Replace compressed contexts of the updated articles
+        for batch in _batches([row["id"] for row in changed]):
+            session.execute(delete(HrefContextModel).where(HrefContextModel.href_id.in_(batch)))
+        for batch in _batches([{"href_id": existing[url], "data": data} for url, data in compressed.items()]):
+            session.execute(insert(HrefContextModel), batch)
+
+    logger.debug("Saved %d new and %d updated articles", len(new), len(changed))
+
+
+def export_hrefs(path: Path) -> int:
+    """
+    Export the scalar columns of the stored articles into a Parquet dataset, partitioned by date.
+    """
+    from klikinsaastaja_ng.analytics import write_parquet
+
+    columns = (
+        HrefModel.url,
+        HrefModel.original_url,
+        HrefModel.title,
+        HrefModel.original_title,
+        HrefModel.sensationalism,
+        HrefModel.published,
+        HrefModel.created,
+    )
+    with unit_of_work() as session:
+        rows = session.execute(select(*columns).execution_options(yield_per=BATCH_SIZE))
+        return write_parquet((row._asdict() for row in rows), path)
+
+
+def report(path: Path):
+    """
+    Print the clickbait scores per outlet and day from an export.
+    """
+    from klikinsaastaja_ng.analytics import clickbait_by_outlet_day
+
+    for row in clickbait_by_outlet_day(path).to_pylist():
+        print(row)
 
 
 def login_to_helsingin_sanomat(browser):
@@ -200,145 +406,43 @@ def fetch_lastest_helsingin_sanomat() -> List[Href]:
 
 
 
+from klikinsaastaja_ng.bot import invoke
+from klikinsaastaja_ng.browser import close_browser_pool
+from klikinsaastaja_ng.context import compact_context
+from klikinsaastaja_ng.feeds import FeedPoller, SeenIndex
+from klikinsaastaja_ng.main import generate_bot_prompt
+from klikinsaastaja_ng.outlet import outlet
 from klikinsaastaja_ng.utils import parse_bot_response
+from klikinsaastaja_ng.worker import JobQueue, Worker
 
 
-def fetch_page_html(url, browser: Browser):
-    """
-    Fetches the html of the news article page.
-    """
-
-    # Remove javascript warnings and errors produced by browser
-    def _filter(record):
-        if record.levelno >= logging.INFO:
-            if record.msg.startswith("[JavaScript Warning:") or record.msg.startswith("[JavaScript Error:"):
-                return False
-
-        return True
-
-    # FIXME: Filter might be added multiple times
-    _logger = logging.getLogger("playwright.browser")
-    _logger.addFilter(_filter)
-
-    def console_log(msg):
-        """
-        Log the playwright ConsoleMessage objects.
-        """
-
-        level_map = {
-            "log": logging.DEBUG,
-            "warning": logging.WARNING,
-            "error": logging.ERROR,
-            "info": logging.INFO,
-            "assert": logging.ERROR,
-            "debug": logging.DEBUG,
-        }
-        if msg.type not in level_map:
-            return
-
-        # Construct log record
-        record = logging.LogRecord(
-            name="playwright",
-            level=level_map[msg.type],
-            pathname=msg.location["url"],
-            lineno=msg.location["lineNumber"],
-            msg=msg.text,
-            args=(),
-            exc_info=None,
-        )
-
-        # Log the record
-        _logger.handle(record)
-
-    page = browser.new_page()
-    page.on("console", console_log)
-
-    page.goto(url)
-    # Ignore timout errors
-    try:
-        # Prevent media from autoplaying
-        page.add_script_tag(content=r"document.querySelectorAll('video').forEach((v) => { v.pause(); });")
-        # Wait for the page to load
-        page.wait_for_load_state("networkidle")
-    except TimeoutError as e:
-        logger.debug("Timout error while loading page %r: %r", url, e)
-
-    # Convert relative links to absolute links
-    page.add_script_tag(
-        content=r"""
-        document.querySelectorAll('a').forEach((a) => {
-            if (a.getAttribute("href").startsWith('/')) {
-                a.href = new URL(a.href, window.location.origin).href;
-            }
-        });
-        """
-    )
+def build(url):
 
-    html_content = page.content()
+    article = outlet(url).get(url, locale=LOCALE)
 
-    # Validate content length
-    content_length = len(html_content)
+    content_length = len(article.article_html)
     logger.debug("Content length: %r", content_length)
     if content_length < 100:
-        logger.debug("Page content: %r", html_content)
         raise Exception("Content length is too short")
 
-    page.close()
-
-    article = newspaper.article(url)
-    article.download(html_content).parse()
-
-    return article
-
-
-def build(url):
-
-    # Get locale
-    locale = LOCALE
-    locale_hint = random.choice(_patched_get_location_hint_from_locale(locale))
-
-    with sync_playwright() as playwright:
-        # TODO: Maybe change into edge for edgegpt
-        browser = playwright.firefox.launch(headless=True, firefox_user_prefs={
-            "media.autoplay.default": 0,
-        })
-        browser_context = browser.new_context(
-            locale=locale.replace("_", "-"),
-            geolocation={
-                "longitude": locale_hint['Center']['Longitude'],
-                "latitude": locale_hint['Center']['Latitude'],
-            },
-        )
-
-        article = fetch_page_html(url, browser=browser)
-
-        content_length = len(article.article_html)
-        logger.debug("Content length: %r", content_length)
-        if content_length < 100:
-            raise Exception("Content length is too short")
-
-        cookies = browser_context.cookies()
-        logger.debug("Browser cookies: %r", cookies, extra={'cookies': cookies})
-
-        browser_context.close()
-        browser.close()
-
-    prompt = generate_bot_prompt(article)
-    context = md(article.article_html, heading_style="ATX").strip()
+    prompt = generate_bot_prompt(article, instructions)
+    compacted = compact_context(md(article.article_html, heading_style="ATX").strip())
+    logger.info("Context: %d tokens, %d before compaction", compacted.tokens_after, compacted.tokens_before)
+    context = compacted.text
 
     print(context)
 
     truncated_context = repr(context[:150]) + " ... " + repr(context[-100:]) if len(context) > 255 else context
     logger.debug("Extracted context: %r", truncated_context, extra={'markup': True, 'context': context})
 
-    bot_response = query_bot_suggestion(prompt, context)
+    bot_response = invoke(prompt, context, locale=LOCALE)
     bot_suggestion = parse_bot_response(bot_response)
 
     # Create a new HrefModel object
     article = HrefModel(
         url=article.url,
         title=bot_suggestion['title'],
-        original_url=article.original_url,
+        original_url=url,
         original_title=article.title,
         context=context,
         reasoning=bot_suggestion['reasoning'],
@@ -349,16 +453,44 @@ def build(url):
 
 
 def get_href_by_url(url):
-    session = get_db_session()
-    article = session.query(HrefModel).filter_by(original_url=url).first()
-    if article is None:
-        article = build(url)
-        session.add(article)
-        session.commit()
+    url = str(url)
+    errors = {}
+    hrefs = get_hrefs_by_urls([url], load_text=True, errors=errors)
+    if url in errors:
+        raise errors[url]
+    return hrefs[url]
 
-    logger.debug(article)
 
-    return article
+def get_hrefs_by_urls(
+    urls: Iterable[str], load_text: bool = False, errors: Dict[str, Exception] = None
+) -> Dict[str, HrefModel]:
+    """
+    Get stored articles, building the missing ones. Missing articles are saved in one batch.
+
+    Articles that fail to build are logged and left out, so the ones already built are still saved.
+
+    :param errors: Failed URLs are added into this dict, with their exception.
+    """
+    urls = list(dict.fromkeys(str(url) for url in urls))
+    hrefs = get_hrefs(urls, load_text)
+
+    built = []
+    for url in (url for url in urls if url not in hrefs):
+        try:
+            built.append(build(url))
+        except Exception as e:
+            logger.error("Building article %r failed: %r", url, e)
+            if errors is not None:
+                errors[url] = e
+
+    if built:
+        save_hrefs(built)
+        hrefs = get_hrefs(urls, load_text)
+
+    for article in hrefs.values():
+        logger.debug(article)
+
+    return hrefs
 
 
 def test():
@@ -380,6 +512,66 @@ def test():
     })
 
 
+def poll():
+    """
+    Poll the outlet feeds and print new articles as they appear.
+
+    Seen articles are kept in memory only, so previewing doesn't hide them from the worker.
+    """
+
+    async def _poll():
+        queue = asyncio.Queue()
+        poller = FeedPoller([IltalehtiFeed()], queue, index=SeenIndex(":memory:"))
+        task = asyncio.create_task(poller.run())
+        try:
+            while True:
+                href = await queue.get()
+                print({'url': str(href.url), 'title': href.title})
+        finally:
+            task.cancel()
+            logger.debug("Poller stats: %r", poller.stats)
+
+    try:
+        asyncio.run(_poll())
+    except KeyboardInterrupt:
+        pass
+
+
+def work():
+    """
+    Poll the outlet feeds and rewrite the titles of new articles, until interrupted.
+    """
+    def store(job, payload, suggestion):
+        save_hrefs([HrefModel(
+            url=payload['url'],
+            title=suggestion['title'],
+            original_url=payload['original_url'],
+            original_title=payload['original_title'],
+            context=payload['context'],
+            reasoning=suggestion['reasoning'],
+            sensationalism=suggestion['clickbaitiness score'],
+            published=datetime.fromisoformat(payload['published']) if payload['published'] else None,
+        )])
+
+    async def _work():
+        queue = JobQueue()
+        worker = Worker(queue, instructions, on_result=store, locale=LOCALE)
+        poller = FeedPoller([IltalehtiFeed()], queue)
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, worker.stop)
+
+        polling = asyncio.create_task(poller.run())
+        try:
+            await worker.run()
+        finally:
+            polling.cancel()
+            await close_browser_pool()
+
+    asyncio.run(_work())
+
+
 def login_to_bing():
     """
     Login to bing and save cookies.
@@ -400,9 +592,24 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Generate a title for a news article")
     parser.add_argument("url", help="URL of the news article. Use 'test' to fetch a random article from Iltalehti.", nargs="?", default="test")
+    parser.add_argument("--poll", action="store_true", help="Poll the outlet feeds and print new articles.")
+    parser.add_argument("--worker", action="store_true", help="Keep rewriting the titles of new feed articles.")
+    parser.add_argument("--export", metavar="DIR", type=Path, help="Export stored articles as Parquet into DIR.")
+    parser.add_argument("--report", metavar="DIR", type=Path, help="Print clickbait scores from a Parquet export.")
     args = parser.parse_args()
 
-    if args.url == "test":
+    # Set up the database once, before any work starts
+    get_engine()
+
+    if args.export:
+        print(f"Exported {export_hrefs(args.export)} articles to {args.export}")
+    elif args.report:
+        report(args.report)
+    elif args.worker:
+        work()
+    elif args.poll:
+        poll()
+    elif args.url == "test":
         test()
     else:
         data = get_href_by_url(args.url)
@@ -1,38 +1,14 @@
 from klikinsäästäjä import *
-from klikinsäästäjä import _patched_get_location_hint_from_locale
 
 
 def main(url):
 
-    # Get locale
-    locale = LOCALE
-    locale_hint = random.choice(_patched_get_location_hint_from_locale(locale))
+    article = outlet(url).get(url, locale=LOCALE)
 
-    with sync_playwright() as playwright:
-        # TODO: Maybe change into edge for edgegpt
-        browser = playwright.firefox.launch(headless=True, firefox_user_prefs={
-            "media.autoplay.default": 0,
-        })
-        browser_context = browser.new_context(
-            locale=locale.replace("_", "-"),
-            geolocation={
-                "longitude": locale_hint['Center']['Longitude'],
-                "latitude": locale_hint['Center']['Latitude'],
-            },
-        )
-
-        article = fetch_page_html(url, browser=browser)
-
-        content_length = len(article.article_html)
-        logger.debug("Content length: %r", content_length)
-        if content_length < 100:
-            raise Exception("Content length is too short")
-
-        cookies = browser_context.cookies()
-        logger.debug("Browser cookies: %r", cookies, extra={'cookies': cookies})
-
-        browser_context.close()
-        browser.close()
+    content_length = len(article.article_html)
+    logger.debug("Content length: %r", content_length)
+    if content_length < 100:
+        raise Exception("Content length is too short")
 
     instructions = """
 The following news page article may contain content of intrest groups or people who has vested interest on the topic.
@@ -72,7 +48,7 @@ Use the following template for your answer:
     truncated_context = repr(context[:150]) + " ... " + repr(context[-100:]) if len(context) > 255 else context
     logger.debug("Extracted context: %r", truncated_context, extra={'markup': True, 'context': context})
 
-    bot_response = query_bot_suggestion(prompt, context)
+    bot_response = invoke(prompt, context, locale=LOCALE)
     print(bot_response)
     return bot_response
 
@@ -0,0 +1,120 @@
+"""
+Columnar export and analytics of the rewritten titles.
+
+Only the scalar columns are exported, into a Parquet dataset partitioned by the publishing date, so aggregates over
+thousands of articles read a few small columns instead of the article contexts and reasoning. Requires `pyarrow`.
+"""
+
+import logging
+from pathlib import Path
+from typing import Iterable, Iterator, Mapping
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+# Rows per record batch
+BATCH_SIZE = 10_000
+
+# Host part of an URL, like `www.iltalehti.fi`
+_HOST = r"^[A-Za-z][A-Za-z0-9+.-]*://(?:[^@/]*@)?(?P<host>[^:/?#]+)"
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("Analytics requires pyarrow. Install it with `pip install pyarrow`.")
+
+
+def schema() -> "pa.Schema":
+    _require_pyarrow()
+    return pa.schema([
+        ("url", pa.string()),
+        ("original_url", pa.string()),
+        ("title", pa.string()),
+        ("original_title", pa.string()),
+        ("sensationalism", pa.float64()),
+        ("published", pa.timestamp("us")),
+        ("created", pa.timestamp("us")),
+    ])
+
+
+def _record_batches(rows: Iterable[Mapping], batch_size: int) -> Iterator["pa.RecordBatch"]:
+    columns = schema()
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield _with_partition_columns(pa.RecordBatch.from_pylist(batch, schema=columns))
+            batch = []
+    if batch:
+        yield _with_partition_columns(pa.RecordBatch.from_pylist(batch, schema=columns))
+
+
+def _with_partition_columns(batch: "pa.RecordBatch") -> "pa.RecordBatch":
+    """
+    Add the `outlet` (lowercased host of the original URL) and `date` (publishing date, or creation date) columns.
+    """
+    outlet = pc.utf8_lower(pc.struct_field(pc.extract_regex(batch.column("original_url"), _HOST), [0]))
+    date = pc.cast(pc.coalesce(batch.column("published"), batch.column("created")), pa.date32())
+    return pa.RecordBatch.from_arrays(
+        [*batch.columns, outlet, date], names=[*batch.schema.names, "outlet", "date"]
+    )
+
+
+def _partitioning() -> "ds.Partitioning":
+    return ds.partitioning(pa.schema([("date", pa.date32())]), flavor="hive")
+
+
+def write_parquet(rows: Iterable[Mapping], path: Path, batch_size: int = BATCH_SIZE) -> int:
+    """
+    Write rows with the :func:`schema` columns into a Parquet dataset at `path`, partitioned by date.
+
+    Rows are converted in batches, so the whole export is never held in memory. Partitions present in the export
+    replace the existing ones, other partitions are kept.
+
+    :return: Number of rows written.
+    """
+    _require_pyarrow()
+    written = 0
+
+    def _counted(batches):
+        nonlocal written
+        for batch in batches:
+            written += batch.num_rows
+            yield batch
+
+    partitioned = schema().append(pa.field("outlet", pa.string())).append(pa.field("date", pa.date32()))
+    ds.write_dataset(
+        _counted(_record_batches(rows, batch_size)),
+        Path(path),
+        schema=partitioned,
+        format="parquet",
+        partitioning=_partitioning(),
+        existing_data_behavior="delete_matching",
+    )
+    logger.debug("Exported %d rows to %s", written, path)
+    return written
+
+
+def dataset(path: Path) -> "ds.Dataset":
+    _require_pyarrow()
+    return ds.dataset(Path(path), format="parquet", partitioning=_partitioning())
+
+
+def clickbait_by_outlet_day(path: Path) -> "pa.Table":
+    """
+    Mean, maximum and count of the sensationalism scores per outlet and day.
+
+    Reads only the `outlet`, `date` and `sensationalism` columns.
+    """
+    table = dataset(path).to_table(columns=["outlet", "date", "sensationalism"])
+    return (
+        table.group_by(["outlet", "date"])
+        .aggregate([("sensationalism", "mean"), ("sensationalism", "max"), ("sensationalism", "count")])
+        .sort_by([("date", "ascending"), ("outlet", "ascending")])
+    )
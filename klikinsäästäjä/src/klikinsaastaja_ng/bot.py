@@ -1,10 +1,16 @@
 import asyncio
+from collections import Counter
+from contextlib import asynccontextmanager
 from enum import Enum
 import json
 import logging
 from pathlib import Path
-from typing import Dict, List
+import time
+from typing import AsyncIterator, Dict, Iterator, List
+import weakref
 from platformdirs import user_data_dir
+from . import runner
+from .cache import response_cache
 from .settings import settings
 
 from EdgeGPT.EdgeGPT import Chatbot, ConversationStyle
@@ -14,6 +20,11 @@ logger = logging.getLogger(__name__)
 # Path to the cookies file
 COOKIES_FILE = Path(user_data_dir("klikinsaastaja-ng"), "edgegpt-cookies.json")
 
+# Chatbot mode used for all requests
+BOT_MODE = "gpt4-turbo"
+
+BOT_PROXY = "http://proxy.jyu.fi:8080"
+
 # Monekypatch get_location_hint_from_locale to support Finnish
 from EdgeGPT.utilities import get_location_hint_from_locale as _get_location_hint_from_locale  # noqa: E402
 import EdgeGPT.request  # noqa: E402
@@ -65,42 +76,314 @@ def _patched_get_location_hint_from_locale(locale: str) -> List[Dict]:
 EdgeGPT.request.get_location_hint_from_locale = _patched_get_location_hint_from_locale
 
 
-async def async_invoke_bot(prompt: str, webpage_context: str = None, locale="fi_FI"):
-
-    # Load cookies
-    cookies = []
-    if settings.edgegpt_bing_cookie__U:
-        cookies.append({
-            'name': '_U',
-            'value': settings.edgegpt_bing_cookie__U,
-        })
-
-    if COOKIES_FILE.exists():
-        logger.debug("Loading cookies %s", COOKIES_FILE)
-        cookies += json.loads(COOKIES_FILE.read_text())
-
-    bot = await Chatbot.create(cookies=cookies, proxy="http://proxy.jyu.fi:8080")
-    response = await bot.ask(
-        prompt=prompt,
-        conversation_style=ConversationStyle.precise,
-        simplify_response=True,
-        locale=locale,
-        webpage_context=webpage_context,
-        no_search=True,
-        mode="gpt4-turbo",
-    )
+# Retire sessions with this many messages left. `Chatbot.ask()` raises on the answer that uses the last message, so
+# a session with one left can't answer again.
+MIN_MESSAGES_LEFT = 1
+
+
+class PooledChatbot:
+    """
+    Chatbot session checked out from :class:`ChatbotPool`.
+    """
+
+    def __init__(self, bot: Chatbot):
+        self.bot = bot
+        self.created = time.monotonic()
+        self.uses = 0
+        self.retired = False
+
+    def retire(self):
+        """
+        Don't return session to the pool, e.g. when the conversation has run out of messages.
+        """
+        self.retired = True
+
+    def retire_if_exhausted(self, messages_left: int | None):
+        """
+        Retire the session when the conversation is running out of messages. `None` means unknown.
+        """
+        if messages_left is not None and messages_left <= MIN_MESSAGES_LEFT:
+            self.retire()
+
+
+class ChatbotPool:
+    """
+    Bounded pool of warm chatbot sessions.
+
+    Creating a chatbot session costs a conversation handshake, so sessions are created ahead of time and reused.
+    A session is recycled after `max_uses` questions, after `max_age` seconds, or when a question fails, and a
+    replacement is warmed up in the background. Concurrent use is capped at `size` sessions.
+
+    Bing conversations remember earlier questions, so by default each session answers only one question and the
+    pool just hides the handshake latency.
+    """
+
+    def __init__(self, size: int = None, max_uses: int = None, max_age: float = None):
+        self.size = settings.chatbot_pool_size if size is None else size
+        self.max_uses = settings.chatbot_max_uses if max_uses is None else max_uses
+        self.max_age = settings.chatbot_max_age if max_age is None else max_age
+
+        self.stats = Counter(acquired=0, created=0, recycled=0, errors=0)
+        self.wait_time = 0.0
+        self.waiting = 0
+        self.in_use = 0
+
+        self._idle: asyncio.Queue[PooledChatbot] = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.size)
+        self._warming = set()
+        self._creating = 0
+        self._cookies = None
+        self._cookies_mtime = None
+
+    def cookies(self) -> List[Dict]:
+        """
+        Cookies for the chatbot. The cookie file is parsed only when it changes.
+        """
+        mtime = COOKIES_FILE.stat().st_mtime if COOKIES_FILE.exists() else None
+        if self._cookies is None or mtime != self._cookies_mtime:
+            cookies = []
+            if settings.edgegpt_bing_cookie__U:
+                cookies.append({
+                    'name': '_U',
+                    'value': settings.edgegpt_bing_cookie__U,
+                })
+
+            if mtime is not None:
+                logger.debug("Loading cookies %s", COOKIES_FILE)
+                cookies += json.loads(COOKIES_FILE.read_text())
+
+            self._cookies, self._cookies_mtime = cookies, mtime
+        return self._cookies
+
+    async def _create(self) -> PooledChatbot:
+        bot = await Chatbot.create(cookies=self.cookies(), proxy=BOT_PROXY)
+        self.stats["created"] += 1
+        return PooledChatbot(bot)
+
+    async def _close(self, session: PooledChatbot):
+        self.stats["recycled"] += 1
+        try:
+            await session.bot.close()
+        except Exception as e:
+            logger.debug("Error while closing chatbot session: %r", e)
+
+    def _is_healthy(self, session: PooledChatbot) -> bool:
+        return (
+            not session.retired
+            and session.uses < self.max_uses
+            and time.monotonic() - session.created < self.max_age
+        )
+
+    async def _warm(self):
+        """
+        Create a session in the background, so the next caller doesn't wait for the handshake.
+        """
+        if self._idle.qsize() + self.in_use + self._creating >= self.size:
+            return
+
+        self._creating += 1
+        try:
+            session = await self._create()
+        except Exception as e:
+            logger.warning("Failed to warm up chatbot session: %r", e)
+            return
+        finally:
+            self._creating -= 1
+
+        self._idle.put_nowait(session)
+
+    def _schedule_warm(self):
+        task = asyncio.ensure_future(self._warm())
+        self._warming.add(task)
+        task.add_done_callback(self._warming.discard)
+
+    def warm_up(self, count: int = None):
+        """
+        Start creating `count` sessions (default: pool size) in the background, e.g. before a batch run.
+        """
+        for _ in range(min(count or self.size, self.size)):
+            self._schedule_warm()
+
+    @asynccontextmanager
+    async def session(self) -> AsyncIterator[PooledChatbot]:
+        """
+        Check out a session. Waits if all sessions are in use.
+        """
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.wait_time += time.monotonic() - started
+
+        self.in_use += 1
+        self.stats["acquired"] += 1
+        session = None
+        try:
+            while session is None and not self._idle.empty():
+                session = self._idle.get_nowait()
+                if not self._is_healthy(session):
+                    await self._close(session)
+                    session = None
+
+            if session is None:
+                session = await self._create()
+
+            try:
+                yield session
+            except BaseException:
+                self.stats["errors"] += 1
+                session.retire()
+                raise
+            finally:
+                session.uses += 1
+        finally:
+            self.in_use -= 1
+            self._slots.release()
+
+            if session is not None:
+                if self._is_healthy(session):
+                    self._idle.put_nowait(session)
+                else:
+                    await self._close(session)
+                    self._schedule_warm()
+
+    def metrics(self) -> Dict:
+        """
+        Pool occupancy and wait time.
+        """
+        acquired = self.stats["acquired"]
+        return {
+            "size": self.size,
+            "in_use": self.in_use,
+            "idle": self._idle.qsize(),
+            "waiting": self.waiting,
+            "wait_time": self.wait_time,
+            "avg_wait_time": self.wait_time / acquired if acquired else 0.0,
+            **self.stats,
+        }
+
+    async def close(self):
+        for task in self._warming:
+            task.cancel()
+        while not self._idle.empty():
+            await self._close(self._idle.get_nowait())
+
+
+# Asyncio primitives are bound to a single event loop, so each loop gets its own pool
+_pools: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, ChatbotPool]" = weakref.WeakKeyDictionary()
+
+
+def chatbot_pool() -> ChatbotPool:
+    """
+    Chatbot pool for the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _pools:
+        _pools[loop] = ChatbotPool()
+    return _pools[loop]
+
+
+async def async_invoke_bot(prompt: str, webpage_context: str = None, locale="fi_FI", cache: bool = True):
+    """
+    Ask the chatbot. Responses are cached by prompt, context, mode and locale.
+
+    :param cache: Set to False to bypass the response cache. The fresh response is still stored.
+    """
+
+    cache_key = response_cache().key(prompt, webpage_context, BOT_MODE, locale)
+    if cache and (cached := response_cache().get(cache_key)) is not None:
+        logger.debug("Using cached response %s", cache_key)
+        return cached
+
+    async with chatbot_pool().session() as session:
+        response = await session.bot.ask(
+            prompt=prompt,
+            conversation_style=ConversationStyle.precise,
+            simplify_response=True,
+            locale=locale,
+            webpage_context=webpage_context,
+            no_search=True,
+            mode=BOT_MODE,
+        )
+        session.retire_if_exhausted(response.get("messages_left"))
+
     logger.debug(response)
     #print(response)
-    await bot.close()
+
+    response_cache().put(cache_key, response['text'])
     return response['text']
 
 
-def invoke(prompt: str, webpage_context: str = None, locale="fi_FI"):
-    """ Run async_invoke_bot() as a synchronous function """
-    try:
-        loop = asyncio.get_event_loop()
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
+def _response_text(response: Dict) -> str | None:
+    """
+    Extract answer text from the final, raw chatbot response.
+    """
+    for message in reversed(response["item"]["messages"]):
+        if message.get("adaptiveCards") and message["adaptiveCards"][0]["body"][0].get("text"):
+            return message["text"]
+    return None
+
+
+async def async_stream_bot(
+    prompt: str, webpage_context: str = None, locale="fi_FI", cache: bool = True
+) -> AsyncIterator[str]:
+    """
+    Ask the chatbot, yielding the answer as it is generated. Each item is the full text received so far.
+
+    A cached answer is yielded at once.
+    """
+
+    cache_key = response_cache().key(prompt, webpage_context, BOT_MODE, locale)
+    if cache and (cached := response_cache().get(cache_key)) is not None:
+        logger.debug("Using cached response %s", cache_key)
+        yield cached
+        return
+
+    text = ""
+    async with chatbot_pool().session() as session:
+        async for final, response in session.bot.ask_stream(
+            prompt=prompt,
+            conversation_style=ConversationStyle.precise,
+            locale=locale,
+            webpage_context=webpage_context,
+            no_search=True,
+            mode=BOT_MODE,
+        ):
+            if not final:
+                text = response
+                yield text
+                continue
+
+            logger.debug(response)
+            throttling = response["item"].get("throttling", {})
+            if "maxNumUserMessagesInConversation" in throttling:
+                session.retire_if_exhausted(
+                    throttling["maxNumUserMessagesInConversation"] - throttling.get("numUserMessagesInConversation", 0)
+                )
+
+            text = _response_text(response) or text
+
+    if not text:
+        raise Exception("No message found")
 
-    response = loop.run_until_complete(async_invoke_bot(prompt, webpage_context, locale=locale))
-    return response
+    response_cache().put(cache_key, text)
+    yield text
+
+
+def invoke(prompt: str, webpage_context: str = None, locale="fi_FI", cache: bool = True):
+    """
+    Run async_invoke_bot() as a synchronous function.
+
+    The call runs on the shared background event loop, so it is safe from any thread and concurrent callers share
+    the chatbot pool.
+    """
+    return runner.run(async_invoke_bot(prompt, webpage_context, locale=locale, cache=cache))
+
+
+def stream(prompt: str, webpage_context: str = None, locale="fi_FI", cache: bool = True) -> Iterator[str]:
+    """
+    Run async_stream_bot() as a synchronous generator on the shared background event loop.
+    """
+    return runner.iterate(async_stream_bot(prompt, webpage_context, locale=locale, cache=cache))
@@ -0,0 +1,371 @@
+"""
+Headless browser pool for fetching JavaScript heavy news pages.
+"""
+
+import asyncio
+import logging
+import random
+import time
+import weakref
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Iterable, List
+from urllib.parse import urlparse
+
+import newspaper
+from playwright.async_api import Browser, BrowserContext, Page, Playwright, Route, TimeoutError, async_playwright
+
+from . import runner
+from .bot import _patched_get_location_hint_from_locale
+from .settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _filter_javascript_messages(record: logging.LogRecord) -> bool:
+    """
+    Remove javascript warnings and errors produced by browser
+    """
+    if record.levelno >= logging.INFO:
+        if record.msg.startswith("[JavaScript Warning:") or record.msg.startswith("[JavaScript Error:"):
+            return False
+
+    return True
+
+
+_browser_logger = logging.getLogger("playwright.browser")
+_browser_logger.addFilter(_filter_javascript_messages)
+
+_CONSOLE_LEVELS = {
+    "log": logging.DEBUG,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+    "info": logging.INFO,
+    "assert": logging.ERROR,
+    "debug": logging.DEBUG,
+}
+
+
+def _console_log(msg):
+    """
+    Log the playwright ConsoleMessage objects.
+    """
+    if msg.type not in _CONSOLE_LEVELS:
+        return
+
+    # Construct log record
+    record = logging.LogRecord(
+        name="playwright",
+        level=_CONSOLE_LEVELS[msg.type],
+        pathname=msg.location["url"],
+        lineno=msg.location["lineNumber"],
+        msg=msg.text,
+        args=(),
+        exc_info=None,
+    )
+
+    # Log the record
+    _browser_logger.handle(record)
+
+
+# Resolves once the DOM has not changed for `quiet` milliseconds, or after `timeout` milliseconds
+_DOM_QUIET_SCRIPT = r"""
+([quiet, timeout]) => new Promise((resolve) => {
+    let timer;
+    const observer = new MutationObserver(() => {
+        clearTimeout(timer);
+        timer = setTimeout(done, quiet);
+    });
+    const done = () => {
+        observer.disconnect();
+        resolve();
+    };
+    observer.observe(document.documentElement, {childList: true, subtree: true, characterData: true});
+    timer = setTimeout(done, quiet);
+    setTimeout(done, timeout);
+})
+"""
+
+
+class RequestFilter:
+    """
+    Request interception policy. Blocks resource types, like images and fonts, and requests to listed domains
+    and their subdomains.
+    """
+
+    def __init__(self, resource_types: Iterable[str] = None, domains: Iterable[str] = None):
+        self.resource_types = frozenset(settings.browser_blocked_resources if resource_types is None else resource_types)
+        self.domains = frozenset(d.lower() for d in (settings.browser_blocked_domains if domains is None else domains))
+        self.stats = Counter(allowed=0, blocked=0)
+
+    def is_blocked(self, resource_type: str, url: str) -> bool:
+        if resource_type in self.resource_types:
+            return True
+
+        # Check the host and each parent domain, `a.b.example.com` -> `b.example.com` -> `example.com`
+        host = (urlparse(url).hostname or "").split(".")
+        return any(".".join(host[i:]) in self.domains for i in range(len(host) - 1))
+
+    async def __call__(self, route: Route):
+        request = route.request
+        if self.is_blocked(request.resource_type, request.url):
+            self.stats["blocked"] += 1
+            await route.abort()
+        else:
+            self.stats["allowed"] += 1
+            await route.continue_()
+
+    def __bool__(self) -> bool:
+        return bool(self.resource_types or self.domains)
+
+
+class PooledContext:
+    def __init__(self, context: BrowserContext, locale: str):
+        self.context = context
+        self.locale = locale
+        self.pages = 0
+        self.open = 0
+        self.retiring = False
+
+
+class BrowserPool:
+    """
+    Long-lived pool of headless Firefox browsers and browser contexts.
+
+    Browsers are launched on first use and kept running. Pages are opened in the least busy context of the requested
+    locale, and a context is recycled after it has served `pages_per_context` pages, to drop accumulated cookies,
+    cache and memory. Up to `contexts` contexts are kept per locale, and at most `max_pages` pages are open at once.
+
+    :param locale: Default locale of pages, when :meth:`page` isn't given one.
+    """
+
+    def __init__(
+        self,
+        browsers: int = None,
+        contexts: int = None,
+        max_pages: int = None,
+        pages_per_context: int = None,
+        locale: str = "fi-FI",
+        request_filter: RequestFilter = None,
+    ):
+        self.browsers = settings.browser_pool_browsers if browsers is None else browsers
+        self.contexts = settings.browser_pool_contexts if contexts is None else contexts
+        self.max_pages = settings.browser_max_pages if max_pages is None else max_pages
+        self.pages_per_context = settings.browser_pages_per_context if pages_per_context is None else pages_per_context
+        self.locale = locale
+        self.request_filter = RequestFilter() if request_filter is None else request_filter
+        self.stats = Counter(pages=0, contexts_created=0, contexts_recycled=0, browsers_launched=0)
+        # Total seconds spent in each phase of fetching a page
+        self.timings: Dict[str, float] = defaultdict(float)
+
+        self._playwright: Playwright | None = None
+        self._browsers: List[Browser] = []
+        self._contexts: List[PooledContext] = []
+        self._pages = asyncio.Semaphore(self.max_pages)
+        self._lock = asyncio.Lock()
+
+    async def _browser(self) -> Browser:
+        """
+        Pick a browser, launching or relaunching them as needed. Caller must hold the lock.
+        """
+        if self._playwright is None:
+            self._playwright = await async_playwright().start()
+
+        self._browsers = [browser for browser in self._browsers if browser.is_connected()]
+        if len(self._browsers) < self.browsers:
+            # TODO: Maybe change into edge for edgegpt
+            browser = await self._playwright.firefox.launch(headless=True, firefox_user_prefs={
+                "media.autoplay.default": 0,
+            })
+            self._browsers.append(browser)
+            self.stats["browsers_launched"] += 1
+            return browser
+
+        return self._browsers[self.stats["contexts_created"] % len(self._browsers)]
+
+    async def _new_context(self, locale: str) -> PooledContext:
+        browser = await self._browser()
+        locale_hint = random.choice(_patched_get_location_hint_from_locale(locale))
+        context = await browser.new_context(
+            locale=locale.replace("_", "-"),
+            geolocation={
+                "longitude": locale_hint['Center']['Longitude'],
+                "latitude": locale_hint['Center']['Latitude'],
+            },
+        )
+        if self.request_filter:
+            await context.route("**/*", self.request_filter)
+        self.stats["contexts_created"] += 1
+        return PooledContext(context, locale)
+
+    async def _checkout(self, locale: str) -> PooledContext:
+        async with self._lock:
+            # Contexts of crashed browsers are dropped too
+            self._contexts = [
+                c for c in self._contexts if not c.retiring and c.context.browser and c.context.browser.is_connected()
+            ]
+            contexts = [c for c in self._contexts if c.locale == locale]
+            if len(contexts) < self.contexts:
+                contexts.append(await self._new_context(locale))
+                self._contexts.append(contexts[-1])
+
+            pooled = min(contexts, key=lambda c: c.open)
+            pooled.open += 1
+            pooled.pages += 1
+            if pooled.pages >= self.pages_per_context:
+                pooled.retiring = True
+            return pooled
+
+    async def _checkin(self, pooled: PooledContext):
+        pooled.open -= 1
+        if pooled.retiring and pooled.open == 0:
+            self.stats["contexts_recycled"] += 1
+            try:
+                await pooled.context.close()
+            except Exception as e:
+                logger.debug("Error while closing browser context: %r", e)
+
+    @asynccontextmanager
+    async def page(self, locale: str = None) -> AsyncIterator[Page]:
+        """
+        Borrow a new page in a context of `locale`. The page is closed when the block exits.
+        """
+        async with self._pages:
+            pooled = await self._checkout(locale or self.locale)
+            try:
+                page = await pooled.context.new_page()
+                self.stats["pages"] += 1
+                try:
+                    yield page
+                finally:
+                    await page.close()
+            finally:
+                await self._checkin(pooled)
+
+    def record(self, phase: str, seconds: float):
+        """
+        Add time spent in a fetch phase to :attr:`timings`.
+        """
+        self.timings[phase] += seconds
+
+    def metrics(self) -> Dict:
+        pages = self.stats["pages"] or 1
+        return {
+            "browsers": len(self._browsers),
+            "contexts": len(self._contexts),
+            "open_pages": sum(c.open for c in self._contexts),
+            **self.stats,
+            **{f"requests_{k}": v for k, v in self.request_filter.stats.items()},
+            # Average milliseconds per page
+            **{f"{phase}_ms": round(total / pages * 1000, 1) for phase, total in self.timings.items()},
+        }
+
+    async def close(self):
+        async with self._lock:
+            for browser in self._browsers:
+                await browser.close()
+            if self._playwright is not None:
+                await self._playwright.stop()
+
+            self._playwright = None
+            self._browsers = []
+            self._contexts = []
+
+
+# Asyncio primitives are bound to a single event loop, so each loop gets its own pool
+_pools: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, BrowserPool]" = weakref.WeakKeyDictionary()
+
+
+def browser_pool() -> BrowserPool:
+    """
+    Browser pool for the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _pools:
+        _pools[loop] = BrowserPool()
+    return _pools[loop]
+
+
+async def close_browser_pool():
+    """
+    Close the browsers of the running event loop's pool, and stop Playwright.
+    """
+    if (pool := _pools.pop(asyncio.get_running_loop(), None)) is not None:
+        await pool.close()
+
+
+# The shared background loop outlives the callers, so its pool is closed when the loop is stopped
+runner.add_cleanup(close_browser_pool)
+
+
+async def fetch_page_html(
+    url: str, pool: BrowserPool = None, locale: str = "fi-FI", ready_selector: str = None
+) -> newspaper.Article:
+    """
+    Fetches the html of the news article page, using a page borrowed from `pool`.
+
+    Instead of waiting for the network to go idle, which news sites with ads and analytics rarely do, the page is
+    read once `ready_selector` is visible, or if it's not given, once the DOM stops changing.
+    """
+    pool = pool or browser_pool()
+    timeout = settings.browser_ready_timeout * 1000
+
+    async with pool.page(locale) as page:
+        page.on("console", _console_log)
+
+        started = time.perf_counter()
+        await page.goto(url, wait_until="domcontentloaded")
+        loaded = time.perf_counter()
+        pool.record("goto", loaded - started)
+
+        # Ignore timout errors
+        try:
+            # Prevent media from autoplaying
+            await page.add_script_tag(content=r"document.querySelectorAll('video').forEach((v) => { v.pause(); });")
+            # Wait for the article to render
+            if ready_selector:
+                await page.wait_for_selector(ready_selector, timeout=timeout)
+            else:
+                await page.evaluate(_DOM_QUIET_SCRIPT, [settings.browser_dom_quiet * 1000, timeout])
+        except TimeoutError as e:
+            logger.debug("Timout error while waiting for page %r: %r", url, e)
+        ready = time.perf_counter()
+        pool.record("ready", ready - loaded)
+
+        # Convert relative links to absolute links
+        await page.add_script_tag(
+            content=r"""
+            document.querySelectorAll('a').forEach((a) => {
+                if (a.getAttribute("href").startsWith('/')) {
+                    a.href = new URL(a.href, window.location.origin).href;
+                }
+            });
+            """
+        )
+
+        html_content = await page.content()
+        pool.record("content", time.perf_counter() - ready)
+
+    # Validate content length
+    content_length = len(html_content)
+    logger.debug("Content length: %r", content_length)
+    if content_length < 100:
+        logger.debug("Page content: %r", html_content)
+        raise Exception("Content length is too short")
+
+    # Parsing is CPU bound, keep it off the event loop
+    parse_started = time.perf_counter()
+    article = await asyncio.to_thread(_parse_article, url, html_content)
+    pool.record("parse", time.perf_counter() - parse_started)
+
+    logger.debug(
+        "Fetched %r in %.0f ms (load %.0f ms, ready %.0f ms)",
+        url, (time.perf_counter() - started) * 1000, (loaded - started) * 1000, (ready - loaded) * 1000,
+    )
+    return article
+
+
+def _parse_article(url: str, html: str) -> newspaper.Article:
+    article = newspaper.Article(url)
+    article.download(html).parse()
+    return article
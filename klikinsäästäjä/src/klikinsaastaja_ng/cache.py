@@ -0,0 +1,334 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Mapping, NamedTuple, Tuple
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+
+import newspaper
+from platformdirs import user_data_dir
+
+from .settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Path to the cache directory
+CACHE_DIR = Path(user_data_dir("klikinsaastaja-ng"), "cache")
+
+# Parsed article fields stored alongside the raw HTML
+ARTICLE_FIELDS = (
+    "title",
+    "text",
+    "article_html",
+    "authors",
+    "publish_date",
+    "top_image",
+    "canonical_link",
+    "meta_lang",
+    "meta_description",
+    "meta_site_name",
+)
+
+# Query parameters that don't change the article content
+TRACKING_PARAMS = ("utm_", "fbclid", "gclid", "mc_")
+
+
+def canonical_url(url: str) -> str:
+    """
+    Normalize URL for use as cache key: lowercase scheme and host, drop fragment and tracking parameters.
+    """
+    parts = urlparse(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not k.startswith(TRACKING_PARAMS)]
+    return urlunparse(parts._replace(
+        scheme=parts.scheme.lower(),
+        netloc=parts.netloc.lower(),
+        path=parts.path or "/",
+        query=urlencode(query),
+        fragment="",
+    ))
+
+
+class CachedArticle(NamedTuple):
+    url: str
+    final_url: str
+    digest: str
+    etag: str | None
+    last_modified: str | None
+    fields: Dict
+    fetched: float
+
+    def is_fresh(self, max_age: int) -> bool:
+        return time.time() - self.fetched < max_age
+
+    def validators(self) -> Dict[str, str]:
+        """
+        Headers for a conditional request.
+        """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ArticleCache:
+    """
+    On-disk cache for fetched articles.
+
+    Raw HTML is stored content-addressed by its sha256 digest under `blobs/`, and an SQLite index maps canonical
+    URLs to the blob, the HTTP validators and the parsed article fields. Least recently used entries are evicted
+    once the blobs exceed `max_size` bytes.
+    """
+
+    def __init__(self, path: Path = CACHE_DIR, max_size: int = None, max_age: int = None):
+        self.path = Path(path)
+        self.max_size = settings.article_cache_max_size if max_size is None else max_size
+        self.max_age = settings.article_cache_max_age if max_age is None else max_age
+        self.stats = Counter(hits=0, stale=0, misses=0, revalidated=0, evicted=0)
+
+        (self.path / "blobs").mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path / "articles.db", check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS articles (
+                url TEXT PRIMARY KEY,
+                final_url TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fields TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                fetched REAL NOT NULL,
+                accessed REAL NOT NULL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS articles_accessed ON articles (accessed)")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS fetch_tiers (
+                key TEXT PRIMARY KEY,
+                tier TEXT NOT NULL,
+                updated REAL NOT NULL
+            )
+        """)
+
+    def _blob(self, digest: str) -> Path:
+        return self.path / "blobs" / digest[:2] / f"{digest}.html"
+
+    def get(self, url: str) -> CachedArticle | None:
+        """
+        Cached entry of `url`, also when it's stale. Fresh entries are counted as hits, and stale ones, which the
+        caller revalidates over the network, separately as stale.
+        """
+        key = canonical_url(url)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT url, final_url, digest, etag, last_modified, fields, fetched FROM articles WHERE url = ?",
+                (key,),
+            ).fetchone()
+            if row is None or not self._blob(row[2]).exists():
+                self.stats["misses"] += 1
+                return None
+
+            self._db.execute("UPDATE articles SET accessed = ? WHERE url = ?", (time.time(), key))
+            entry = CachedArticle(*row[:5], json.loads(row[5]), row[6])
+            self.stats["hits" if entry.is_fresh(self.max_age) else "stale"] += 1
+
+        return entry
+
+    def put(self, url: str, article: newspaper.Article, headers: Mapping[str, str] = None):
+        """
+        Store fetched and parsed article.
+        """
+        if self.max_size <= 0:
+            return
+
+        headers = headers or {}
+        html = article.html.encode("utf-8")
+        digest = hashlib.sha256(html).hexdigest()
+
+        blob = self._blob(digest)
+        if not blob.exists():
+            blob.parent.mkdir(exist_ok=True)
+            blob.write_bytes(html)
+
+        fields = {field: getattr(article, field, None) for field in ARTICLE_FIELDS}
+        if isinstance(fields["publish_date"], datetime):
+            fields["publish_date"] = fields["publish_date"].isoformat()
+
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO articles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    canonical_url(url), article.url, digest, headers.get("ETag"), headers.get("Last-Modified"),
+                    json.dumps(fields, default=list), len(html), now, now,
+                ),
+            )
+            self._evict()
+
+    def revalidated(self, url: str, headers: Mapping[str, str] = None):
+        """
+        Mark entry as fresh after the server answered `304 Not Modified`.
+        """
+        headers = headers or {}
+        with self._lock:
+            self.stats["revalidated"] += 1
+            self._db.execute(
+                "UPDATE articles SET fetched = ?, etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified)"
+                " WHERE url = ?",
+                (time.time(), headers.get("ETag"), headers.get("Last-Modified"), canonical_url(url)),
+            )
+
+    def fetch_tier(self, key: str) -> Tuple[str, float] | None:
+        """
+        Fetch tier that last worked for outlet `key`, and when it was recorded.
+        """
+        with self._lock:
+            return self._db.execute("SELECT tier, updated FROM fetch_tiers WHERE key = ?", (key,)).fetchone()
+
+    def set_fetch_tier(self, key: str, tier: str):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO fetch_tiers VALUES (?, ?, ?)", (key, tier, time.time()))
+
+    def article(self, entry: CachedArticle) -> newspaper.Article:
+        """
+        Rebuild :class:`newspaper.Article` from the cache entry without parsing the HTML again.
+        """
+        article = newspaper.Article(entry.url)
+        article.html = self._blob(entry.digest).read_text(encoding="utf-8")
+        for field, value in entry.fields.items():
+            setattr(article, field, value)
+
+        if entry.fields.get("publish_date"):
+            article.publish_date = datetime.fromisoformat(entry.fields["publish_date"])
+
+        article.url = entry.final_url
+        article.is_parsed = True
+        return article
+
+    def _evict(self):
+        """
+        Drop least recently accessed entries until the cache fits in `max_size`. Caller must hold the lock.
+        """
+        # Blobs are shared between URLs with identical content, count each only once
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT digest, size FROM articles)")
+        total = total.fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        for url, digest, size in self._db.execute(
+            "SELECT url, digest, size FROM articles ORDER BY accessed"
+        ).fetchall():
+            self._db.execute("DELETE FROM articles WHERE url = ?", (url,))
+            self.stats["evicted"] += 1
+
+            if self._db.execute("SELECT 1 FROM articles WHERE digest = ?", (digest,)).fetchone() is None:
+                self._blob(digest).unlink(missing_ok=True)
+                total -= size
+
+            if total <= self.max_size:
+                break
+
+        logger.debug("Evicted article cache down to %d bytes", total)
+
+
+class ResponseCache:
+    """
+    SQLite cache for chatbot responses.
+
+    Responses are keyed by a hash of the rendered prompt, webpage context, mode and locale. Entries expire after
+    `ttl` seconds, and least recently used entries are evicted once the responses exceed `max_size` bytes.
+    """
+
+    def __init__(self, path: Path = CACHE_DIR, ttl: int = None, max_size: int = None):
+        self.ttl = settings.response_cache_ttl if ttl is None else ttl
+        self.max_size = settings.response_cache_max_size if max_size is None else max_size
+        self.stats = Counter(hits=0, misses=0, evicted=0)
+
+        Path(path).mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(Path(path, "responses.db"), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    @staticmethod
+    def key(prompt: str, webpage_context: str | None, mode: str, locale: str) -> str:
+        payload = json.dumps([prompt, webpage_context, mode, locale], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT response FROM responses WHERE key = ? AND created > ?", (key, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.stats["hits"] += 1
+
+        return row[0]
+
+    def put(self, key: str, response: str):
+        if self.max_size <= 0:
+            return
+
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, response, len(response.encode("utf-8")), now, now),
+            )
+            self._evict(now)
+
+    def _evict(self, now: float):
+        """
+        Drop expired entries, then least recently accessed ones until the cache fits in `max_size`.
+        Caller must hold the lock.
+        """
+        self.stats["evicted"] += self._db.execute(
+            "DELETE FROM responses WHERE created <= ?", (now - self.ttl,)
+        ).rowcount
+
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+            if total <= self.max_size:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.stats["evicted"] += 1
+            total -= size
+
+
+@lru_cache(maxsize=None)
+def article_cache() -> ArticleCache:
+    """
+    Shared :class:`ArticleCache` instance.
+    """
+    return ArticleCache()
+
+
+@lru_cache(maxsize=None)
+def response_cache() -> ResponseCache:
+    """
+    Shared :class:`ResponseCache` instance.
+    """
+    return ResponseCache()
@@ -0,0 +1,192 @@
+"""
+Compact article markdown before sending it to the chatbot.
+
+The markdownified article contains image and link markup, navigation leftovers, repeated teasers and reader
+comments, none of which the prompts need. Compaction strips those, and truncates the rest to a token budget while
+keeping the beginning and the end of the article.
+"""
+
+import logging
+import re
+from functools import lru_cache
+from typing import Callable, List, NamedTuple
+
+from .settings import settings
+
+logger = logging.getLogger(__name__)
+
+_IMAGE = re.compile(r"!\[[^\]]*\]\([^)]*\)")
+_LINK = re.compile(r"\[([^\]]*)\]\([^)]*\)")
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+_WHITESPACE = re.compile(r"\s+")
+
+# Short paragraphs that are site furniture rather than article content
+_BOILERPLATE = re.compile(
+    r"^[#*>\s-]*(?:(?:mainos|lue myös|lue lisää|katso myös|jaa artikkeli|jaa|tilaa|seuraa meitä|advertisement"
+    r"|read more|related|share|subscribe|follow us)\b|kuva:)",
+    re.IGNORECASE,
+)
+# Longer paragraphs are article content, even if they start with a boilerplate word
+BOILERPLATE_MAX_LENGTH = 60
+
+# Everything after a comments heading is reader comments
+_COMMENTS = re.compile(r"^#+\s*(kommentit|kommentoi|lukijoiden kommentit|comments)\b", re.IGNORECASE)
+
+TRUNCATION_MARKER = "[…]"
+
+
+class CompactedContext(NamedTuple):
+    text: str
+    tokens_before: int
+    tokens_after: int
+
+
+@lru_cache(maxsize=None)
+def _token_counter() -> Callable[[str], int]:
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding("cl100k_base")
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except ImportError:
+        pass
+    except Exception as e:
+        # Encoding isn't cached locally and can't be downloaded
+        logger.warning("Loading tiktoken encoding failed, estimating tokens from text length: %r", e)
+
+    # Rough estimate for when tiktoken is not available
+    return lambda text: (len(text) + 3) // 4
+
+
+def count_tokens(text: str) -> int:
+    """
+    Count tokens with tiktoken, or estimate them from the text length if tiktoken or its encoding is not available.
+    """
+    return _token_counter()(text)
+
+
+def _clean_paragraphs(markdown: str) -> List[str]:
+    markdown = _IMAGE.sub("", markdown)
+    markdown = _LINK.sub(r"\1", markdown)
+
+    paragraphs = []
+    seen = set()
+    for paragraph in _PARAGRAPH_BREAK.split(markdown):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) < BOILERPLATE_MAX_LENGTH and _BOILERPLATE.match(paragraph):
+            logger.debug("Dropping boilerplate paragraph %r", paragraph)
+            continue
+        if _COMMENTS.match(paragraph):
+            break
+
+        # Teasers and captions are often repeated
+        key = _WHITESPACE.sub(" ", paragraph).casefold()
+        if key in seen:
+            continue
+        seen.add(key)
+
+        paragraphs.append(paragraph)
+    return paragraphs
+
+
+def _cut(paragraph: str, max_tokens: int) -> str:
+    """
+    Longest beginning of the paragraph within `max_tokens`, cut at whitespace when possible.
+    """
+    if max_tokens <= 0:
+        return ""
+
+    # Binary search for the longest prefix that fits
+    low, high = 0, len(paragraph)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(paragraph[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+
+    cut = paragraph[:low]
+    if low < len(paragraph) and (space := cut.rfind(" ")) > 0:
+        cut = cut[:space]
+    return cut.rstrip()
+
+
+def _truncate(paragraphs: List[str], max_tokens: int) -> List[str]:
+    """
+    Keep paragraphs from the head and the tail of the article, two thirds of the budget for the head.
+
+    The budget the tail doesn't use goes to the head, and the first paragraph that doesn't fit is cut by characters,
+    so an article with a short lead and one long body keeps the beginning of the body. The truncation marker is
+    added only when something was removed, and the joined result stays within `max_tokens`.
+    """
+    tokens = [count_tokens(p) for p in paragraphs]
+    separator = count_tokens("\n\n")
+    budget = max_tokens - count_tokens(TRUNCATION_MARKER) - 2 * separator
+
+    head, used = [], 0
+    for paragraph, count in zip(paragraphs, tokens):
+        if used + count + separator > budget * 2 // 3:
+            break
+        head.append(paragraph)
+        used += count + separator
+
+    tail, tail_used = [], 0
+    for paragraph, count in zip(reversed(paragraphs[len(head):]), reversed(tokens[len(head):])):
+        if tail_used + count + separator > budget - budget * 2 // 3:
+            break
+        tail.insert(0, paragraph)
+        tail_used += count + separator
+    tail_start = len(paragraphs) - len(tail)
+
+    # Fill the rest of the budget with the beginning of the paragraphs in between
+    remaining = budget - used - tail_used
+    for paragraph, count in zip(paragraphs[len(head):tail_start], tokens[len(head):tail_start]):
+        if count + separator <= remaining:
+            head.append(paragraph)
+            remaining -= count + separator
+            continue
+        if cut := _cut(paragraph, remaining - separator):
+            head.append(cut)
+        break
+
+    if len(head) == tail_start and (not head or head[-1] == paragraphs[len(head) - 1]):
+        # Nothing was removed
+        return paragraphs
+
+    result = head + [TRUNCATION_MARKER] + tail
+
+    # Token counts of joined text aren't exactly additive, drop or cut more until it fits
+    while (excess := count_tokens("\n\n".join(result)) - max_tokens) > 0:
+        if tail:
+            tail.pop(0)
+        elif head:
+            head[-1] = _cut(head[-1], count_tokens(head[-1]) - excess)
+            if not head[-1]:
+                head.pop()
+        else:
+            break
+        result = head + [TRUNCATION_MARKER] + tail
+
+    return result
+
+
+def compact_context(markdown: str, max_tokens: int = None) -> CompactedContext:
+    """
+    Strip images, links, boilerplate, reader comments and repeated paragraphs from article markdown, and truncate
+    it to `max_tokens`.
+
+    :param markdown: Article as markdown
+    :param max_tokens: Token budget. Defaults to `settings.context_max_tokens`, 0 disables truncation.
+    """
+    max_tokens = settings.context_max_tokens if max_tokens is None else max_tokens
+    tokens_before = count_tokens(markdown)
+
+    paragraphs = _clean_paragraphs(markdown)
+    text = "\n\n".join(paragraphs)
+    if paragraphs and max_tokens and count_tokens(text) > max_tokens:
+        text = "\n\n".join(_truncate(paragraphs, max_tokens))
+
+    context = CompactedContext(text, tokens_before, count_tokens(text))
+    logger.debug("Compacted context from %d to %d tokens", context.tokens_before, context.tokens_after)
+    return context
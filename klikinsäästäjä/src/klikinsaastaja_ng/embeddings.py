@@ -0,0 +1,256 @@
+"""
+Text embeddings for the RAG corpus.
+
+The embedding function and model are chosen from settings, and the model is loaded once, on the first text that
+isn't already cached. Vectors are cached in SQLite by model and text hash, so a text is embedded only once per model.
+Texts not in the cache are embedded in batches limited by count and characters.
+
+:class:`Embeddings` implements ``embed_documents()`` and ``embed_query()``, so it can be used as the embedding
+function of a langchain vector store.
+"""
+
+import hashlib
+import logging
+import random
+import sqlite3
+import threading
+import time
+from array import array
+from collections import Counter
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List
+
+from .cache import CACHE_DIR
+from .settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Maximum hashes per cache lookup
+LOOKUP_BATCH_SIZE = 500
+
+# Dimensions of the vectors of `FakeEmbeddings`
+FAKE_DIMENSIONS = 384
+
+EmbedFunction = Callable[[List[str]], List[List[float]]]
+
+
+class VectorCache:
+    """
+    SQLite cache of embedding vectors, keyed by model and the sha256 digest of the text. Vectors are stored as
+    float32.
+    """
+
+    def __init__(self, path: Path = CACHE_DIR):
+        Path(path).mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(Path(path, "embeddings.db"), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS vectors (
+                model TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                PRIMARY KEY (model, digest)
+            ) WITHOUT ROWID
+        """)
+
+    @staticmethod
+    def digest(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, model: str, digests: Iterable[str]) -> Dict[str, List[float]]:
+        digests = list(dict.fromkeys(digests))
+        vectors = {}
+        with self._lock:
+            for i in range(0, len(digests), LOOKUP_BATCH_SIZE):
+                batch = digests[i:i + LOOKUP_BATCH_SIZE]
+                for digest, blob in self._db.execute(
+                    f"SELECT digest, vector FROM vectors WHERE model = ? AND digest IN ({','.join('?' * len(batch))})",
+                    (model, *batch),
+                ):
+                    vectors[digest] = array("f", blob).tolist()
+        return vectors
+
+    def put_many(self, model: str, vectors: Dict[str, List[float]]):
+        with self._lock, self._db:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "INSERT OR REPLACE INTO vectors VALUES (?, ?, ?)",
+                ((model, digest, array("f", vector).tobytes()) for digest, vector in vectors.items()),
+            )
+
+
+def _sentence_transformers(model: str) -> EmbedFunction:
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError as e:
+        raise ImportError(
+            "HuggingFaceEmbeddings requires sentence-transformers. Install it with `pip install sentence-transformers`."
+        ) from e
+
+    if settings.embedding_threads > 0:
+        import torch
+
+        torch.set_num_threads(settings.embedding_threads)
+
+    kwargs = {}
+    if settings.embedding_backend != "torch":
+        kwargs["backend"] = settings.embedding_backend
+    if settings.embedding_model_file:
+        kwargs["model_kwargs"] = {"file_name": settings.embedding_model_file}
+
+    encoder = SentenceTransformer(model, token=settings.hf_token or None, **kwargs)
+
+    def embed(texts: List[str]) -> List[List[float]]:
+        return encoder.encode(texts, batch_size=len(texts), convert_to_numpy=True).tolist()
+
+    return embed
+
+
+def _openai(model: str) -> EmbedFunction:
+    try:
+        from openai import OpenAI
+    except ImportError as e:
+        raise ImportError("OpenAIEmbeddings requires openai. Install it with `pip install openai`.") from e
+
+    client = OpenAI(api_key=settings.openai_api_key or None)
+
+    def embed(texts: List[str]) -> List[List[float]]:
+        response = client.embeddings.create(model=model, input=texts)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    return embed
+
+
+def _gpt4all(model: str) -> EmbedFunction:
+    try:
+        from gpt4all import Embed4All
+    except ImportError as e:
+        raise ImportError("GPT4AllEmbeddings requires gpt4all. Install it with `pip install gpt4all`.") from e
+
+    encoder = Embed4All(n_threads=settings.embedding_threads or None)
+
+    def embed(texts: List[str]) -> List[List[float]]:
+        return [encoder.embed(text) for text in texts]
+
+    return embed
+
+
+def _fake(model: str) -> EmbedFunction:
+    def embed(texts: List[str]) -> List[List[float]]:
+        # Deterministic random vectors, seeded by the text
+        return [
+            [rng.gauss(0, 1) for _ in range(FAKE_DIMENSIONS)]
+            for rng in (random.Random(VectorCache.digest(text)) for text in texts)
+        ]
+
+    return embed
+
+
+# Embedding functions by the settings name
+BACKENDS: Dict[str, Callable[[str], EmbedFunction]] = {
+    "HuggingFaceEmbeddings": _sentence_transformers,
+    "OpenAIEmbeddings": _openai,
+    "GPT4AllEmbeddings": _gpt4all,
+    "FakeEmbeddings": _fake,
+}
+
+
+class Embeddings:
+    """
+    Cached and batched embedding service.
+
+    :param function: Embedding function name, one of :data:`BACKENDS`. Defaults to `settings.embedding_function`.
+    :param model: Model name. Defaults to the model setting of the embedding function.
+    """
+
+    def __init__(self, function: str = None, model: str = None, cache: VectorCache = None):
+        self.function = function or settings.embedding_function
+        if self.function not in BACKENDS:
+            raise ValueError(f"Unknown embedding function {self.function!r}, expected one of {list(BACKENDS)}")
+
+        self.model = model or {
+            "HuggingFaceEmbeddings": settings.hugginface_embedding_model,
+            "OpenAIEmbeddings": settings.openai_embedding_model,
+        }.get(self.function, "")
+
+        # Cache key of the model. Vectors of a quantized model file aren't mixed with the full model.
+        self.name = f"{self.function}/{self.model}"
+        if self.function == "HuggingFaceEmbeddings" and settings.embedding_model_file:
+            self.name += f"/{settings.embedding_model_file}"
+
+        self.cache = cache or VectorCache()
+        self.stats = Counter(texts=0, cached=0, embedded=0, batches=0)
+        self.seconds = 0.0
+
+        self._embed: EmbedFunction | None = None
+        self._load_lock = threading.Lock()
+
+    def _embedder(self) -> EmbedFunction:
+        with self._load_lock:
+            if self._embed is None:
+                started = time.monotonic()
+                self._embed = BACKENDS[self.function](self.model)
+                logger.info("Loaded embedding model %s in %.1f s", self.name, time.monotonic() - started)
+        return self._embed
+
+    @staticmethod
+    def _batches(texts: List[str]) -> Iterator[List[str]]:
+        """
+        Split texts into batches of at most `settings.embedding_batch_size` texts and
+        `settings.embedding_batch_chars` characters. Texts are sorted by length, so batches pad less.
+        """
+        batch, chars = [], 0
+        for text in sorted(texts, key=len):
+            if batch and (
+                len(batch) >= settings.embedding_batch_size or chars + len(text) > settings.embedding_batch_chars
+            ):
+                yield batch
+                batch, chars = [], 0
+            batch.append(text)
+            chars += len(text)
+        if batch:
+            yield batch
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        started = time.monotonic()
+        digests = [VectorCache.digest(text) for text in texts]
+        vectors = self.cache.get_many(self.name, digests)
+
+        missing = list({digest: text for digest, text in zip(digests, texts) if digest not in vectors}.values())
+        for batch in self._batches(missing):
+            embedded = dict(zip((VectorCache.digest(text) for text in batch), self._embedder()(batch)))
+            self.cache.put_many(self.name, embedded)
+            vectors.update(embedded)
+            self.stats["batches"] += 1
+
+        elapsed = time.monotonic() - started
+        self.seconds += elapsed
+        self.stats["texts"] += len(texts)
+        self.stats["embedded"] += len(missing)
+        self.stats["cached"] += len(texts) - len(missing)
+        if missing:
+            logger.info(
+                "Embedded %d texts in %.2f s (%.0f texts/s), %d reused",
+                len(missing), elapsed, len(missing) / elapsed if elapsed else 0, len(texts) - len(missing),
+            )
+
+        return [vectors[digest] for digest in digests]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    def metrics(self) -> Dict:
+        return {
+            **self.stats,
+            "texts_per_second": self.stats["texts"] / self.seconds if self.seconds else 0.0,
+        }
+
+
+@lru_cache(maxsize=None)
+def embeddings() -> Embeddings:
+    """
+    Shared :class:`Embeddings` instance, configured from settings.
+    """
+    return Embeddings()
@@ -0,0 +1,186 @@
+"""
+Incremental polling of outlet article feeds.
+
+Each feed is fetched with conditional requests, so an unchanged feed costs a `304 Not Modified`. Article IDs that
+have been seen are kept in an SQLite index, and only the new articles are put into the work queue. Checking a feed
+page of any length against the index is a single query.
+"""
+
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Protocol, Tuple
+
+import httpx
+from platformdirs import user_data_dir
+
+from . import http_client
+from .models import Href
+from .settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Path to the feed state database
+FEEDS_DB = Path(user_data_dir("klikinsaastaja-ng"), "feeds.db")
+
+
+class Feed(ABC):
+    """
+    Article listing of an outlet.
+    """
+
+    name: str
+    url: str
+
+    @abstractmethod
+    def parse(self, data: Any) -> Iterable[Tuple[str, Href]]:
+        """
+        Extract ``(article id, link)`` pairs from the decoded JSON response.
+        """
+
+
+class WorkQueue(Protocol):
+    async def put(self, item: Href): ...
+
+
+class SeenIndex:
+    """
+    Persistent index of the feed HTTP validators and seen article IDs.
+
+    :param path: Database path. Use ``":memory:"`` for an index that isn't kept between runs.
+    """
+
+    def __init__(self, path: Path | str = FEEDS_DB):
+        if str(path) != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS feeds (
+                name TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                polled REAL NOT NULL
+            )
+        """)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS seen (
+                feed TEXT NOT NULL,
+                article_id TEXT NOT NULL,
+                url TEXT NOT NULL,
+                seen REAL NOT NULL,
+                PRIMARY KEY (feed, article_id)
+            ) WITHOUT ROWID
+        """)
+
+    def validators(self, feed: str) -> Dict[str, str]:
+        """
+        Headers for a conditional request of the feed.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT etag, last_modified FROM feeds WHERE name = ?", (feed,)).fetchone()
+
+        headers = {}
+        if row and row[0]:
+            headers["If-None-Match"] = row[0]
+        if row and row[1]:
+            headers["If-Modified-Since"] = row[1]
+        return headers
+
+    def polled(self, feed: str, headers: httpx.Headers):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO feeds VALUES (?, ?, ?, ?)",
+                (feed, headers.get("ETag"), headers.get("Last-Modified"), time.time()),
+            )
+
+    def unseen(self, feed: str, items: List[Tuple[str, Href]]) -> List[Tuple[str, Href]]:
+        """
+        Articles that haven't been marked seen, in feed order.
+        """
+        if not items:
+            return []
+
+        ids = [article_id for article_id, _ in items]
+        with self._lock:
+            seen = {
+                row[0]
+                for row in self._db.execute(
+                    f"SELECT article_id FROM seen WHERE feed = ? AND article_id IN ({','.join('?' * len(ids))})",
+                    (feed, *ids),
+                )
+            }
+
+        return list({article_id: href for article_id, href in items if article_id not in seen}.items())
+
+    def mark_seen(self, feed: str, items: List[Tuple[str, Href]]):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "INSERT OR IGNORE INTO seen VALUES (?, ?, ?, ?)",
+                ((feed, article_id, str(href.url), now) for article_id, href in items),
+            )
+
+
+class FeedPoller:
+    """
+    Poll feeds every `interval` seconds and put new articles into `queue`.
+    """
+
+    def __init__(self, feeds: Iterable[Feed], queue: WorkQueue, interval: float = None, index: SeenIndex = None):
+        self.feeds = list(feeds)
+        self.queue = queue
+        self.interval = settings.feed_poll_interval if interval is None else interval
+        self.index = index or SeenIndex()
+        self.stats = Counter(polls=0, not_modified=0, new=0, errors=0)
+
+    async def poll(self, feed: Feed) -> List[Href]:
+        """
+        Fetch the feed once and queue the new articles.
+
+        Articles are marked seen only once they are queued, and the feed validators are stored only when all new
+        articles were queued. An article that fails to queue is retried on the next poll.
+        """
+        self.stats["polls"] += 1
+        response = await http_client.async_client().get(feed.url, headers=self.index.validators(feed.name))
+        if response.status_code == 304:
+            self.stats["not_modified"] += 1
+            return []
+
+        response.raise_for_status()
+        new = self.index.unseen(feed.name, list(feed.parse(response.json())))
+
+        queued = []
+        try:
+            for article_id, href in new:
+                await self.queue.put(href)
+                queued.append((article_id, href))
+        finally:
+            self.index.mark_seen(feed.name, queued)
+            self.stats["new"] += len(queued)
+
+        self.index.polled(feed.name, response.headers)
+        logger.debug("Polled %s: %d new articles", feed.name, len(new))
+        return [href for _, href in new]
+
+    async def run(self):
+        """
+        Poll all feeds until cancelled.
+        """
+        while True:
+            started = time.monotonic()
+            for result, feed in zip(
+                await asyncio.gather(*(self.poll(feed) for feed in self.feeds), return_exceptions=True), self.feeds
+            ):
+                if isinstance(result, Exception):
+                    self.stats["errors"] += 1
+                    logger.warning("Polling feed %s failed: %r", feed.name, result)
+
+            await asyncio.sleep(max(0.0, self.interval - (time.monotonic() - started)))
@@ -0,0 +1,193 @@
+"""
+Shared HTTP clients for fetching articles and feeds.
+
+All outlets and feed pollers share one connection pooled :class:`requests.Session`, and one
+:class:`httpx.AsyncClient` per event loop, so connections to the same host are kept alive between requests.
+Requests have explicit connect and read timeouts, accept gzip and brotli (if installed) compressed responses, and
+are retried with exponential backoff on connection errors, ``429 Too Many Requests`` and server errors.
+"""
+
+import asyncio
+import email.utils
+import logging
+import time
+import weakref
+from collections import Counter
+from functools import lru_cache
+from typing import Dict
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from urllib3.util.retry import Retry
+
+from .settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Responses that are worth retrying after a pause
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+# Don't let a server stall us for longer than this with `Retry-After`, or back off for longer than this
+RETRY_AFTER_MAX = 60
+
+# Request and retry counts of both clients
+STATS = Counter(requests=0, retries=0)
+
+
+class _CountingRetry(Retry):
+    """
+    :class:`Retry` that records the retries in :data:`STATS`, and caps ``Retry-After`` to :data:`RETRY_AFTER_MAX`.
+
+    urllib3 caps only the backoff to `backoff_max`, and sleeps as long as ``Retry-After`` asks.
+    """
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, RETRY_AFTER_MAX)
+
+    def increment(self, method=None, url=None, response=None, error=None, *args, **kwargs):
+        STATS["retries"] += 1
+        if response is not None:
+            STATS[f"retried_{response.status}"] += 1
+        elif error is not None:
+            STATS[f"retried_{type(error).__name__}"] += 1
+        return super().increment(method, url, response, error, *args, **kwargs)
+
+
+class _Session(requests.Session):
+    """
+    Session with default timeouts.
+    """
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault("timeout", (settings.http_connect_timeout, settings.http_read_timeout))
+        STATS["requests"] += 1
+        return super().request(method, url, *args, **kwargs)
+
+
+@lru_cache(maxsize=None)
+def session() -> requests.Session:
+    """
+    Shared :class:`requests.Session`. Safe to use from multiple threads.
+    """
+    retry = _CountingRetry(
+        total=settings.http_retries,
+        backoff_factor=settings.http_backoff,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=RETRY_METHODS,
+        respect_retry_after_header=True,
+        backoff_max=RETRY_AFTER_MAX,
+        # Return the last response instead of raising, callers check the status
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=settings.http_pool_hosts,
+        pool_maxsize=settings.http_pool_per_host,
+        max_retries=retry,
+    )
+
+    s = _Session()
+    s.headers.update(make_headers(accept_encoding=True))
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+
+def _retry_after(response: httpx.Response) -> float | None:
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    if value.isdigit():
+        return min(float(value), RETRY_AFTER_MAX)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return min(max(0.0, date.timestamp() - time.time()), RETRY_AFTER_MAX)
+
+
+class RetryTransport(httpx.AsyncBaseTransport):
+    """
+    Retry idempotent requests on connection errors and :data:`RETRY_STATUSES`, with exponential backoff.
+
+    :class:`httpx.AsyncHTTPTransport` only retries failed connects, and not error responses.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, retries: int, backoff: float):
+        self.transport = transport
+        self.retries = retries
+        self.backoff = backoff
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        STATS["requests"] += 1
+        attempt = 0
+        while True:
+            retryable = request.method in RETRY_METHODS and attempt < self.retries
+            try:
+                response = await self.transport.handle_async_request(request)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError) as e:
+                if not retryable:
+                    raise
+                delay, reason = None, type(e).__name__
+            else:
+                if not retryable or response.status_code not in RETRY_STATUSES:
+                    return response
+                delay, reason = _retry_after(response), response.status_code
+                await response.aclose()
+
+            attempt += 1
+            STATS["retries"] += 1
+            STATS[f"retried_{reason}"] += 1
+            delay = self.backoff * 2 ** (attempt - 1) if delay is None else delay
+            logger.debug("Retrying %s %s in %.1f s (%s)", request.method, request.url, delay, reason)
+            await asyncio.sleep(delay)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+# httpx clients are bound to the event loop they were first used in
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
+
+def async_client() -> httpx.AsyncClient:
+    """
+    Shared :class:`httpx.AsyncClient` for the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _clients:
+        transport = httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(
+                max_connections=settings.http_pool_hosts * settings.http_pool_per_host,
+                max_keepalive_connections=settings.http_pool_hosts * settings.http_pool_per_host,
+            ),
+        )
+        _clients[loop] = httpx.AsyncClient(
+            transport=RetryTransport(transport, settings.http_retries, settings.http_backoff),
+            timeout=httpx.Timeout(settings.http_read_timeout, connect=settings.http_connect_timeout),
+            follow_redirects=True,
+        )
+    return _clients[loop]
+
+
+def metrics() -> Dict:
+    """
+    Request and retry counts, and the connection pools of the shared :func:`session`.
+    """
+    pools = []
+    if session.cache_info().currsize:
+        pools = [
+            pool
+            for adapter in set(session().adapters.values())
+            for pool in (adapter.poolmanager.pools[key] for key in adapter.poolmanager.pools.keys())
+        ]
+
+    return {
+        **STATS,
+        "pooled_hosts": len(pools),
+        "connections_opened": sum(pool.num_connections for pool in pools),
+        # Requests per opened connection tells how well keep-alive works
+        "pooled_requests": sum(pool.num_requests for pool in pools),
+    }
@@ -1,8 +1,10 @@
 from enum import Enum
+from functools import lru_cache
 from pathlib import Path
+from typing import Dict, FrozenSet, Tuple
 
 from importlib.resources import files
-from jinja2 import Template
+from jinja2 import Environment, Template, meta
 
 import newspaper
 
@@ -18,16 +20,46 @@ def user_prompt_file(prompt: PromptFiles) -> Path:
     return Path(platformdirs.user_data_dir("klikinsaastaja-ng")) / prompt.value
 
 
-def get_prompt(prompt: PromptFiles):
+# Shared environment for compiling the prompt templates
+_environment = Environment()
 
-    _user_prompt_file = user_prompt_file(prompt)
-    if _user_prompt_file.exists():
-        return _user_prompt_file.read_text()
+# User prompt file contents, keyed by prompt and invalidated when the file changes
+_user_prompts: Dict[PromptFiles, Tuple[Tuple[int, int], str]] = {}
 
+
+@lru_cache(maxsize=None)
+def _package_prompt(prompt: PromptFiles) -> str:
     resource = f"data/{prompt.value}"
     return files(__package__).joinpath(resource).read_text(encoding="utf-8")
 
 
+def get_prompt(prompt: PromptFiles):
+
+    _user_prompt_file = user_prompt_file(prompt)
+    try:
+        stat = _user_prompt_file.stat()
+    except FileNotFoundError:
+        return _package_prompt(prompt)
+
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = _user_prompts.get(prompt)
+    if cached is None or cached[0] != version:
+        cached = _user_prompts[prompt] = (version, _user_prompt_file.read_text())
+
+    return cached[1]
+
+
+@lru_cache(maxsize=64)
+def compile_prompt(source: str) -> Tuple[Template, FrozenSet[str]]:
+    """
+    Compile prompt template. Returns the template and the names of the variables it uses.
+
+    Compiled templates are cached by their source, so edited prompts are compiled again.
+    """
+    ast = _environment.parse(source)
+    return _environment.from_string(ast), frozenset(meta.find_undeclared_variables(ast))
+
+
 def generate_bot_prompt(article: newspaper.Article, prompt: str | PromptFiles, **kwargs):
     """
     Generates a prompt for the article.
@@ -40,6 +72,10 @@ def generate_bot_prompt(article: newspaper.Article, prompt: str | PromptFiles, *
     if isinstance(prompt, PromptFiles):
         prompt = get_prompt(prompt)
 
-    prompt = Template(prompt).render(**article.__dict__, **kwargs)
+    template, variables = compile_prompt(prompt)
+
+    # Pass only the article fields the template uses
+    context = {name: getattr(article, name) for name in variables - kwargs.keys() if hasattr(article, name)}
+    prompt = template.render(**context, **kwargs)
 
     return prompt
@@ -17,7 +17,8 @@ class NewspaperOutlet(BaseModel):
 
     matching_urls: List[AnyHttpUrl | ParseResult | re.Pattern]
 
-    
+    # CSS selector that appears once the article body is rendered. Used by the browser to stop waiting early.
+    ready_selector: str | None = None
 
     # def get(self, url: AnyHttpUrl) -> Article:
     #     raise NotImplementedError()
@@ -1,38 +1,282 @@
+import asyncio
 import logging
 import re
-from typing import Union
+import time
+from collections import Counter, defaultdict
+from enum import Enum
+from functools import lru_cache
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Tuple, Union
+import httpx
 import newspaper
 import requests
 
+from klikinsaastaja_ng import http_client, runner
+from klikinsaastaja_ng.cache import article_cache
+from klikinsaastaja_ng.context import compact_context
 from klikinsaastaja_ng.utils import markdownify, setup_logging
-from klikinsaastaja_ng.main import generate_bot_prompt
+from klikinsaastaja_ng.main import PromptFiles, generate_bot_prompt
 from klikinsaastaja_ng.models import NewspaperOutlet
+from klikinsaastaja_ng.settings import settings
 from urllib.parse import ParseResult, urlparse
 
+logger = logging.getLogger(__name__)
 
-NEWSPAPER_OUTLETS = []
+_NETLOC = ParseResult._fields.index("netloc")
 
-logger = logging.getLogger(__name__)
+# Literal host at the start of a regular expression rule, like `https://www\.example\.com/`
+_PATTERN_HOST = re.compile(r"\^?https\??://((?:[A-Za-z0-9-]+\\\.)+[A-Za-z0-9-]+)[/$]")
 
-class RequestsSession:
 
-    _session: requests.Session
+class OutletRegistry:
+    """
+    Registry of newspaper outlets.
+
+    Matching rules are compiled when an outlet is registered: host-only rules go into a host index, regular
+    expressions are grouped by their literal host (if any) and combined into a single pattern per group, and the
+    remaining :class:`ParseResult` rules are reduced to the parts that need to be compared. Lookups are cached, so
+    resolving an outlet does not scan every outlet.
+    """
+
+    def __init__(self, cache_size: int = 1024):
+        self._outlets: List[NewspaperOutlet] = []
+        self._hosts: Dict[str, int] = {}
+        self._patterns: Dict[str | None, List[Tuple[int, re.Pattern]]] = defaultdict(list)
+        self._combined: Dict[str | None, re.Pattern | None] = {}
+        self._partial: List[Tuple[int, Tuple[Tuple[int, str], ...]]] = []
+        self.lookup = lru_cache(maxsize=cache_size)(self._lookup)
+
+    def __iter__(self) -> Iterator[NewspaperOutlet]:
+        return iter(self._outlets)
+
+    def __len__(self) -> int:
+        return len(self._outlets)
+
+    def register(self, outlet: NewspaperOutlet) -> NewspaperOutlet:
+        """
+        Add outlet to the registry. Earlier registrations take precedence when multiple outlets match.
+        """
+        index = len(self._outlets)
+        self._outlets.append(outlet)
+
+        for rule in outlet.matching_urls:
+            if isinstance(rule, re.Pattern):
+                host = None
+                if isinstance(rule.pattern, str) and (match := _PATTERN_HOST.match(rule.pattern)):
+                    host = match.group(1).replace("\\.", ".").lower()
+                self._patterns[host].append((index, rule))
+                self._combined[host] = self._combine_patterns(self._patterns[host])
+                continue
+            elif not isinstance(rule, ParseResult):
+                rule = urlparse(str(rule))
+
+            # Only the parts defined in the rule are compared
+            parts = tuple((i, part) for i, part in enumerate(rule) if part)
+            if len(parts) == 1 and parts[0][0] == _NETLOC:
+                self._hosts.setdefault(rule.netloc.lower(), index)
+            else:
+                self._partial.append((index, parts))
+
+        self.lookup.cache_clear()
+        return outlet
+
+    @staticmethod
+    def _combine_patterns(patterns: List[Tuple[int, re.Pattern]]) -> re.Pattern | None:
+        """
+        Combine regular expression rules into a single alternation, one named group per rule.
+
+        Returns None if the rules can't be combined (mixed flags, clashing group names), in which case they are
+        matched one by one.
+        """
+        flags = {rule.flags for _, rule in patterns}
+        if len(flags) > 1:
+            return None
+
+        combined = "|".join(f"(?P<_rule{n}>{rule.pattern})" for n, (_, rule) in enumerate(patterns))
+        try:
+            return re.compile(combined, flags.pop())
+        except (re.error, TypeError):
+            logger.debug("Could not combine outlet patterns, matching them separately")
+            return None
+
+    def _match_pattern(self, url: str, host: str | None) -> int | None:
+        patterns = self._patterns.get(host)
+        if not patterns:
+            return None
+
+        if (combined := self._combined[host]) is not None:
+            if match := combined.match(url):
+                return patterns[int(match.lastgroup.removeprefix("_rule"))][0]
+            return None
+
+        return next((index for index, rule in patterns if rule.match(url)), None)
+
+    def _lookup(self, url: str) -> NewspaperOutlet | None:
+        url_parts = urlparse(url)
+        host = url_parts.netloc.lower()
+
+        # Lowest index wins, same as scanning the outlets in registration order
+        candidates = [self._hosts.get(host), self._match_pattern(url, host), self._match_pattern(url, None)]
+        best = min((i for i in candidates if i is not None), default=len(self._outlets))
+
+        for index, parts in self._partial:
+            if index >= best:
+                break
+            if all(url_parts[i] == part for i, part in parts):
+                best = index
+                break
+
+        if best == len(self._outlets):
+            return None
+
+        logger.debug("Matched outlet %s for URL %s", self._outlets[best].name, url)
+        return self._outlets[best]
+
+
+NEWSPAPER_OUTLETS = OutletRegistry()
+
+
+class RequestsSession:
+    """
+    Fetch articles over HTTP. Articles are cached on disk and revalidated with conditional requests.
+    """
 
     def get(self, url) -> newspaper.Article:
-        if not hasattr(self, "_session"):
-            self._session = requests.Session()
+        cache = article_cache()
+        if (cached := cache.get(url)) is not None and cached.is_fresh(cache.max_age):
+            return cache.article(cached)
+
+        req = http_client.session().get(url, headers=cached.validators() if cached else None)
+        if cached is not None and req.status_code == 304:
+            cache.revalidated(url, req.headers)
+            return cache.article(cached)
+
+        req.raise_for_status()
+
+        return self._parse_article(url, req.text, req.url, req.headers)
+
+    async def aget(self, url, client: httpx.AsyncClient = None) -> newspaper.Article:
+        """
+        Asynchronous version of :meth:`get`. Defaults to the shared async client.
+        """
+        client = client or http_client.async_client()
+        cache = article_cache()
+        if (cached := cache.get(url)) is not None and cached.is_fresh(cache.max_age):
+            return cache.article(cached)
+
+        req = await client.get(url, headers=cached.validators() if cached else None)
+        if cached is not None and req.status_code == 304:
+            cache.revalidated(url, req.headers)
+            return cache.article(cached)
 
-        req = self._session.get(url)
         req.raise_for_status()
 
+        # Parsing is CPU bound, keep it off the event loop
+        return await asyncio.to_thread(self._parse_article, url, req.text, str(req.url), req.headers)
+
+    def _parse_article(self, url, html: str, final_url: str, headers=None) -> newspaper.Article:
         article = newspaper.Article(url)
-        article.download(req.text).parse()
-        article.url = req.url
+        article.download(html).parse()
+        article.url = final_url
+
+        article_cache().put(url, article, headers)
 
         return article
 
 
-class IltaLehti(RequestsSession, NewspaperOutlet):
+class FetchTier(str, Enum):
+    HTTP = "http"
+    BROWSER = "browser"
+
+
+# Extracted article shorter than these is most likely a JavaScript rendered page, a consent wall or a teaser
+MIN_ARTICLE_HTML_LENGTH = 100
+MIN_ARTICLE_TEXT_LENGTH = 200
+
+# How often each tier produced the article
+FETCH_STATS = Counter()
+
+
+def is_complete_article(article: newspaper.Article) -> bool:
+    """
+    Check if the extracted article looks like the full article.
+    """
+    return (
+        len(article.article_html or "") >= MIN_ARTICLE_HTML_LENGTH
+        and len(article.text or "") >= MIN_ARTICLE_TEXT_LENGTH
+    )
+
+
+class TieredSession(RequestsSession):
+    """
+    Fetch articles over plain HTTP, and escalate to the headless browser only if the extracted article is incomplete.
+
+    The tier that worked is remembered per outlet, so outlets that need the browser don't make a wasted HTTP
+    request every time. HTTP is tried again after `settings.fetch_tier_max_age` seconds. The `locale` is used for
+    the browser context.
+    """
+
+    def _tier_key(self, url: str) -> str:
+        return self.name
+
+    def _use_http(self, url: str) -> bool:
+        remembered = article_cache().fetch_tier(self._tier_key(url))
+        if remembered is None or remembered[0] == FetchTier.HTTP:
+            return True
+        return time.time() - remembered[1] > settings.fetch_tier_max_age
+
+    def _remember(self, url: str, tier: FetchTier):
+        FETCH_STATS[tier.value] += 1
+        key = self._tier_key(url)
+        if (remembered := article_cache().fetch_tier(key)) is None or remembered[0] != tier:
+            logger.info("Using %s for %s", tier.value, key)
+        article_cache().set_fetch_tier(key, tier.value)
+
+    def get(self, url, locale: str = "fi-FI") -> newspaper.Article:
+        if self._use_http(url):
+            try:
+                article = super().get(url)
+                if is_complete_article(article):
+                    self._remember(url, FetchTier.HTTP)
+                    return article
+                logger.debug("Incomplete article over HTTP from %r, escalating to browser", url)
+            except requests.RequestException as e:
+                logger.debug("HTTP fetch of %r failed, escalating to browser: %r", url, e)
+
+        return runner.run(self._browser_get(url, locale))
+
+    async def aget(self, url, client: httpx.AsyncClient = None, locale: str = "fi-FI") -> newspaper.Article:
+        if self._use_http(url):
+            try:
+                article = await super().aget(url, client)
+                if is_complete_article(article):
+                    self._remember(url, FetchTier.HTTP)
+                    return article
+                logger.debug("Incomplete article over HTTP from %r, escalating to browser", url)
+            except httpx.HTTPError as e:
+                logger.debug("HTTP fetch of %r failed, escalating to browser: %r", url, e)
+
+        return await self._browser_get(url, locale)
+
+    async def _browser_get(self, url, locale: str) -> newspaper.Article:
+        # Playwright is an optional dependency
+        from klikinsaastaja_ng.browser import fetch_page_html
+
+        cache = article_cache()
+        if (cached := cache.get(url)) is not None and cached.is_fresh(cache.max_age):
+            if is_complete_article(article := cache.article(cached)):
+                return article
+
+        article = await fetch_page_html(url, locale=locale, ready_selector=self.ready_selector)
+        if is_complete_article(article):
+            self._remember(url, FetchTier.BROWSER)
+            await asyncio.to_thread(article_cache().put, url, article)
+        else:
+            logger.warning("Incomplete article from %r even with the browser", url)
+
+        return article
+
+
+class IltaLehti(TieredSession, NewspaperOutlet):
     def __init__(self, *args, **kwargs):
         super().__init__(
             *args,
@@ -40,59 +284,83 @@ class IltaLehti(RequestsSession, NewspaperOutlet):
             matching_urls=[
                 urlparse("//www.iltalehti.fi"),
             ],
+            ready_selector="article p",
             **kwargs,
         )
 
 
-class GenericOutletProvider(NewspaperOutlet, RequestsSession):
-    ...
+class GenericOutletProvider(NewspaperOutlet, TieredSession):
+    def _tier_key(self, url: str) -> str:
+        # Shared by all unknown sites, remember the tier per host instead
+        return urlparse(url).netloc.lower()
 
 
-NEWSPAPER_OUTLETS.append(IltaLehti())
+NEWSPAPER_OUTLETS.register(IltaLehti())
+
+_generic_outlet = GenericOutletProvider(name="GenericOutletProvider", matching_urls=[])
 
 
 def outlet(url) -> NewspaperOutlet:
-    article_url_parts = urlparse(url)
-
-    # Find the outlet that matches the URL
-    # Warning: there be dragons here
-    for outlet in NEWSPAPER_OUTLETS:
-        logger.debug("Checking outlet %s: %r", outlet.name, outlet.matching_urls)
-        for outlet_url_rule in outlet.matching_urls:
-            logger.debug("Checking outlet %s rule %s", outlet.name, outlet_url_rule)
-            if isinstance(outlet_url_rule, re.Pattern):
-                if outlet_url_rule.match(url):
-                    logger.debug(f"Matched `re.Pattern` outlet {outlet.name} for URL {url}")
-                    return outlet
-
-                continue  # URL part does not match, try next outlet
-            elif isinstance(outlet_url_rule, str):
-                logger.debug("Converting string to ParseResult")
-                outlet_url_rule = urlparse(outlet_url_rule)
-
-            # Compare the parts of the URL that are defined in the matching URL
-            for key in outlet_url_rule._fields:
-                logger.debug(f"Checking outlet {outlet.name} for URL {url} part {key}")
-                if outlet_part := getattr(outlet_url_rule, key):
-                    if outlet_part != getattr(article_url_parts, key):
-                        logger.debug("Outlet url part %r does not match %r, try next outlet", outlet_part, getattr(article_url_parts, key))
-                        break  # URL part does not match, try next outlet
-            else:
-                logger.debug(f"Matched outlet {outlet.name} for URL {url}")
-                return outlet
+    if (matched := NEWSPAPER_OUTLETS.lookup(url)) is not None:
+        return matched
 
     logger.warning("No outlet matched %r, returning generic provider", url)
-    return GenericOutletProvider(name="GenericOutletProvider", matching_urls=[])
+    return _generic_outlet
+
+
+def _prompt_and_context(article: newspaper.Article, prompt: str | PromptFiles, **kwargs) -> Tuple[str, str]:
+    prompt = generate_bot_prompt(article, prompt=prompt, **kwargs)
+    context = compact_context(markdownify(article.article_html))
+    logger.info(
+        "Context for %r: %d tokens, %d before compaction", article.url, context.tokens_after, context.tokens_before
+    )
+
+    return prompt, context.text
 
 
 def build(url: str, prompt: str, **kwargs):
     source = outlet(url)
     article = source.get(url)
 
-    prompt = generate_bot_prompt(article, prompt=prompt, **kwargs)
-    context = markdownify(article.article_html)
+    return _prompt_and_context(article, prompt, **kwargs)
+
+
+async def build_many(
+    urls: Iterable[str], prompt: str | PromptFiles, concurrency: int = 8, per_host: int = 2, **kwargs
+) -> AsyncIterator[Tuple[str, str, str]]:
+    """
+    Fetch and build prompts for multiple articles concurrently.
+
+    Yields ``(url, prompt, context)`` tuples in the order the articles finish, so the slowest fetch does not hold
+    back the rest. Articles that fail to fetch or parse are logged and skipped.
+
+    :param urls: Article URLs. Duplicates are fetched only once.
+    :param prompt: The prompt to use. Can be a string or a PromptFiles enum value
+    :param concurrency: Maximum number of articles fetched at the same time
+    :param per_host: Maximum number of concurrent requests to a single host
+    :param kwargs: Additional context to pass to the template
+    """
+    slots = asyncio.Semaphore(concurrency)
+    host_slots: Dict[str, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(per_host))
+    client = http_client.async_client()
+
+    async def _build(url: str) -> Tuple[str, str, str] | None:
+        try:
+            async with host_slots[urlparse(url).netloc], slots:
+                article = await outlet(url).aget(url, client)
+            return (url, *_prompt_and_context(article, prompt, **kwargs))
+        except Exception as e:
+            logger.exception("Failed to build article %r", url, exc_info=e)
+            return None
 
-    return prompt, context
+    tasks = [asyncio.ensure_future(_build(url)) for url in dict.fromkeys(urls)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            if (result := await next_done) is not None:
+                yield result
+    finally:
+        for task in tasks:
+            task.cancel()
 
 
 if __name__ == "__main__":
@@ -1,21 +1,33 @@
-import requests
+import logging
+from typing import Any, Iterable, List, Tuple
 
-def fetch_latest_iltalehti() -> List[Href]:
-    latest_url = r"https://api.il.fi/v1/articles/iltalehti/lists/latest?limit=30&image_sizes[]=size138"
+from klikinsaastaja_ng import http_client
+from klikinsaastaja_ng.feeds import Feed
+from klikinsaastaja_ng.models import Href
+
+logger = logging.getLogger(__name__)
+
+
+class IltalehtiFeed(Feed):
+    name = "iltalehti"
+    url = r"https://api.il.fi/v1/articles/iltalehti/lists/latest?limit=30&image_sizes[]=size138"
     base_url = r"https://www.iltalehti.fi/{category[category_name]}/a/{article_id}"
 
-    response = requests.get(latest_url)
-    data = response.json()
+    def parse(self, data: Any) -> Iterable[Tuple[str, Href]]:
+        for article in data["response"]:
+            # Skip content that has sponsored content metadata
+            if article.get('metadata', {}).get('sponsored_content', False):
+                logger.debug("Skipping sponsored content: %r", article['title'])
+                continue
+
+            url = self.base_url.format(**article)
+            yield str(article['article_id']), Href(url=url, title=article['title'])
 
-    article_links = []
 
-    for article in data["response"]:
-        # Skip content that has sponsored content metadata
-        if article.get('metadata', {}).get('sponsored_content', False):
-            logger.debug("Skipping sponsored content: %r", article['title'])
-            continue
+def fetch_latest_iltalehti() -> List[Href]:
+    feed = IltalehtiFeed()
 
-        url = base_url.format(**article)
-        article_links.append(Href(url, article['title']))
+    response = http_client.session().get(feed.url)
+    response.raise_for_status()
 
-    return article_links
+    return [href for _, href in feed.parse(response.json())]
@@ -0,0 +1,132 @@
+"""
+Background event loop for running coroutines from synchronous code.
+
+Gradio runs handlers in worker threads, which have no event loop of their own. Instead of creating a loop per call,
+coroutines are submitted to one long-lived loop running in a daemon thread, so chatbot sessions and other asyncio
+resources are shared, and calls from different threads run concurrently.
+"""
+
+import asyncio
+import atexit
+import concurrent.futures
+import logging
+import threading
+from typing import Any, AsyncIterator, Awaitable, Callable, Coroutine, Iterator, List, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Seconds to wait for each cleanup when the loop is stopped
+CLEANUP_TIMEOUT = 10
+
+
+class BackgroundLoop:
+    """
+    Event loop running in a daemon thread. Started on first use.
+    """
+
+    def __init__(self, name: str = "klikinsaastaja-ng-loop"):
+        self.name = name
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self._cleanups: List[Callable[[], Awaitable]] = []
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._run, args=(self._loop,), name=self.name, daemon=True)
+                self._thread.start()
+        return self._loop
+
+    @staticmethod
+    def _run(loop: asyncio.AbstractEventLoop):
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_forever()
+        finally:
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
+
+    def submit(self, coro: Coroutine[Any, Any, T]) -> "concurrent.futures.Future[T]":
+        """
+        Schedule coroutine on the loop. Safe to call from any thread.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Coroutine[Any, Any, T], timeout: float | None = None) -> T:
+        """
+        Run coroutine on the loop and wait for the result.
+        """
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError("Can't wait for the background loop from inside it, await the coroutine instead")
+
+        return self.submit(coro).result(timeout)
+
+    def add_cleanup(self, cleanup: Callable[[], Awaitable]):
+        """
+        Register coroutine function to await on the loop before it's stopped, e.g. to close browsers.
+        """
+        self._cleanups.append(cleanup)
+
+    def stop(self):
+        with self._lock:
+            if self._loop is not None and not self._loop.is_closed():
+                for cleanup in self._cleanups:
+                    try:
+                        asyncio.run_coroutine_threadsafe(cleanup(), self._loop).result(CLEANUP_TIMEOUT)
+                    except Exception as e:
+                        logger.warning("Cleanup %r failed: %r", cleanup, e)
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join()
+            self._loop = self._thread = None
+
+
+_background = BackgroundLoop()
+atexit.register(_background.stop)
+
+
+def submit(coro: Coroutine[Any, Any, T]) -> "concurrent.futures.Future[T]":
+    """
+    Schedule coroutine on the shared background loop and return a :class:`concurrent.futures.Future`.
+
+    From another event loop, wait for the result with ``await asyncio.wrap_future(submit(coro))``.
+    """
+    return _background.submit(coro)
+
+
+def run(coro: Coroutine[Any, Any, T], timeout: float | None = None) -> T:
+    """
+    Run coroutine on the shared background loop, blocking until it completes.
+    """
+    return _background.run(coro, timeout)
+
+
+def add_cleanup(cleanup: Callable[[], Awaitable]):
+    """
+    Register coroutine function to await on the shared background loop before it's stopped at exit.
+    """
+    _background.add_cleanup(cleanup)
+
+
+def iterate(iterator: AsyncIterator[T]) -> Iterator[T]:
+    """
+    Iterate asynchronous iterator on the shared background loop from synchronous code.
+    """
+
+    async def _next():
+        return await iterator.__anext__()
+
+    try:
+        while True:
+            try:
+                yield run(_next())
+            except StopAsyncIteration:
+                return
+    finally:
+        if hasattr(iterator, "aclose"):
+            run(iterator.aclose())
@@ -1,3 +1,5 @@
+from typing import List
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import Field
 
@@ -12,11 +14,128 @@ class Settings(BaseSettings):
     openai_api_key: str = Field(default="", env="OPENAI_API_KEY")
     openai_embedding_model: str = Field(default="text-embedding-3-small")
 
+    embedding_batch_size: int = Field(default=64, description="Maximum number of texts per embedding call.")
+    embedding_batch_chars: int = Field(default=200_000, description="Maximum characters per embedding call.")
+    embedding_threads: int = Field(
+        default=0, description="CPU threads for local embedding models. Set to 0 to use the library default."
+    )
+    embedding_backend: str = Field(
+        default="torch",
+        description="Inference backend of the Hugging Face models: `torch`, `onnx` or `openvino`. ONNX requires `sentence-transformers[onnx]`.",
+    )
+    embedding_model_file: str | None = Field(
+        default=None,
+        description="Model file for the ONNX or OpenVINO backend, like `onnx/model_qint8_avx512_vnni.onnx` for a quantized model.",
+    )
+
     edgegpt_bing_cookie__U: str | None = Field(
         default="",
         env="BING_U",
         description="The `_U` cookie from bing.com. Bing cookie is required for the EdgeGPT chatbot to work. You can get it from the browser's devtools.",
     )
 
+    article_cache_max_size: int = Field(
+        default=256 * 1024 * 1024,
+        description="Maximum size of the fetched article cache in bytes. Set to 0 to disable caching.",
+    )
+    article_cache_max_age: int = Field(
+        default=15 * 60,
+        description="Seconds a cached article is used as is, before revalidating it with the server.",
+    )
+
+    response_cache_ttl: int = Field(
+        default=7 * 24 * 60 * 60,
+        description="Seconds a cached chatbot response is reused for the same prompt and article.",
+    )
+    response_cache_max_size: int = Field(
+        default=64 * 1024 * 1024,
+        description="Maximum size of the chatbot response cache in bytes. Set to 0 to disable caching.",
+    )
+
+    http_connect_timeout: float = Field(default=5, description="Seconds to wait for a HTTP connection.")
+    http_read_timeout: float = Field(default=20, description="Seconds to wait for HTTP response data.")
+    http_retries: int = Field(default=3, description="Retries on connection errors, 429 and 5xx responses.")
+    http_backoff: float = Field(
+        default=0.5, description="Backoff factor for HTTP retries. Retry n waits backoff * 2 ** (n - 1) seconds."
+    )
+    http_pool_hosts: int = Field(default=16, description="Number of hosts to keep HTTP connections open to.")
+    http_pool_per_host: int = Field(default=4, description="Number of kept-alive HTTP connections per host.")
+
+    feed_poll_interval: float = Field(default=120, description="Seconds between polls of the outlet article feeds.")
+
+    worker_fetch_concurrency: int = Field(default=4, description="Articles the worker fetches at once.")
+    worker_prompt_concurrency: int = Field(default=2, description="Prompts the worker renders at once.")
+    worker_max_attempts: int = Field(default=5, description="Attempts per stage before a job is dead-lettered.")
+    worker_backoff: float = Field(
+        default=30, description="Seconds before retrying a failed job. Doubles on each attempt."
+    )
+    worker_poll_interval: float = Field(default=5, description="Seconds between job queue checks when idle.")
+    worker_shutdown_timeout: float = Field(
+        default=30, description="Seconds the worker waits for jobs in progress when stopping."
+    )
+
+    fetch_tier_max_age: int = Field(
+        default=24 * 60 * 60,
+        description="Seconds an outlet that needed the headless browser skips plain HTTP, before HTTP is tried again.",
+    )
+
+    chatbot_pool_size: int = Field(default=4, description="Maximum number of concurrent chatbot sessions.")
+    chatbot_max_uses: int = Field(
+        default=1,
+        description="Questions asked in one chatbot conversation before it is recycled. Conversations remember earlier questions.",
+    )
+    chatbot_max_age: float = Field(default=10 * 60, description="Seconds an idle chatbot session is kept warm.")
+
+    context_max_tokens: int = Field(
+        default=3000,
+        description="Token budget for the article context sent to the chatbot. Set to 0 to send the whole article.",
+    )
+    compress_context: bool = Field(
+        default=True,
+        description="Store article contexts zstd compressed in a side table. Requires `zstandard`.",
+    )
+
+    browser_pool_browsers: int = Field(default=1, description="Number of headless browsers to keep running.")
+    browser_pool_contexts: int = Field(default=2, description="Number of browser contexts pages are spread over.")
+    browser_max_pages: int = Field(default=4, description="Maximum number of pages loading at once.")
+    browser_pages_per_context: int = Field(
+        default=20, description="Pages loaded in a browser context before it is replaced with a fresh one."
+    )
+    browser_blocked_resources: List[str] = Field(
+        default=["image", "media", "font"],
+        description="Playwright resource types the browser doesn't load. Article text doesn't need them.",
+    )
+    browser_blocked_domains: List[str] = Field(
+        default=[
+            "doubleclick.net",
+            "googlesyndication.com",
+            "googletagmanager.com",
+            "googletagservices.com",
+            "google-analytics.com",
+            "adnxs.com",
+            "adform.net",
+            "cxense.com",
+            "chartbeat.com",
+            "chartbeat.net",
+            "scorecardresearch.com",
+            "facebook.net",
+            "hotjar.com",
+            "optimizely.com",
+            "cookiebot.com",
+            "sourcepoint.com",
+            "privacy-mgmt.com",
+            "kilkaya.com",
+            "gemius.pl",
+        ],
+        description="Ad and analytics domains, and their subdomains, the browser doesn't load.",
+    )
+    browser_ready_timeout: float = Field(
+        default=10, description="Seconds to wait for the article to be ready, before reading the page as is."
+    )
+    browser_dom_quiet: float = Field(
+        default=0.5,
+        description="Seconds without DOM changes after which a page is considered ready, when the outlet has no ready selector.",
+    )
+
 
 settings = Settings()
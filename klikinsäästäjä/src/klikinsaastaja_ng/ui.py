@@ -4,7 +4,7 @@ from dotenv import load_dotenv
 import gradio as gr
 from klikinsaastaja_ng.main import get_prompt, PromptFiles, user_prompt_file
 from klikinsaastaja_ng.settings import settings
-from klikinsaastaja_ng.utils import parse_bot_response
+from klikinsaastaja_ng.utils import JsonObjectStream
 
 os.environ.setdefault("ANONYMIZED_TELEMETRY", "false")
 os.environ.setdefault('GRADIO_ANALYTICS_ENABLED', 'false')
@@ -122,14 +122,14 @@ def ui_page_settings():
     return settings_tab
 
 
-def analyze_article(url: str, prompt: str, progress=gr.Progress()):
+def analyze_article(url: str, prompt: str, bypass_cache: bool = False, progress=gr.Progress()):
     """
-    Analyze the article
+    Analyze the article. The bot response is streamed, and rows are added as soon as each JSON object completes.
     """
     logger.debug("Analyzing article %r", url)
 
     from .outlet import build
-    from .bot import invoke
+    from .bot import stream
 
     if not url:
         raise gr.Error("URL is required")
@@ -138,16 +138,23 @@ def analyze_article(url: str, prompt: str, progress=gr.Progress()):
     formatterd_prompt, webpage = build(url, prompt)
     yield [f"Article: {webpage}", None]
 
-    result = invoke(formatterd_prompt, webpage)
-    logger.debug("Bot response: %r", result)
-    response = parse_bot_response(result)
+    result = ""
+    parser = JsonObjectStream()
+    for partial in stream(formatterd_prompt, webpage, cache=not bypass_cache):
+        if not partial.startswith(result):
+            # Bot rewrote the response, start over
+            parser = JsonObjectStream()
+            result = ""
+
+        parser.feed(partial[len(result):])
+        result = partial
 
-    data_rows = [d.values() for d in response]
+        yield [
+            result,
+            [list(d.values()) for d in parser.objects] or None,
+        ]
 
-    yield [
-        result,
-        data_rows,
-    ]
+    logger.debug("Bot response: %r", result)
     return
 
 
@@ -168,6 +175,7 @@ def gradio_ui():
 
                     url = gr.Textbox("", label="URL", lines=1, placeholder="https://example.com")
                     analyze_btn = gr.Button("Analyze")
+                    bypass_cache = gr.Checkbox(False, label="Bypass cache", info="Ask the chatbot even if the article has been analyzed before")
 
                 with gr.Accordion('Response', open=False):
                     analyze_result_output = gr.Textbox("", label="Raw response", lines=7)
@@ -177,7 +185,7 @@ def gradio_ui():
                         headers=["lang", "group", "wikipedia query", "reasoning", "rag query"],
                     )
 
-            analyze_btn.click(analyze_article, [url, party_prompt], outputs=[analyze_result_output, analyze_result])
+            analyze_btn.click(analyze_article, [url, party_prompt, bypass_cache], outputs=[analyze_result_output, analyze_result])
 
         with gr.Tab("News analyzer"):
             with gr.Accordion('Prompt', open=False), gr.Group():
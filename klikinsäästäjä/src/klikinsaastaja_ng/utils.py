@@ -1,3 +1,4 @@
+import ast
 import json
 import logging
 import re
@@ -7,6 +8,25 @@ from markdownify import markdownify as _markdownify
 
 logger = logging.getLogger(__name__)
 
+# Strings and trailing commas, for repairing complete JSON in one pass
+_JSON_REPAIR = re.compile(r"""("[^"\\]*(?:\\.[^"\\]*)*")|'([^'\\]*(?:\\.[^'\\]*)*)'|,(\s*[}\]])""", re.DOTALL)
+
+# Contents of a json code block, greedy up to the last closing fence like the original parser. Scanning back from
+# the end of the response is faster than finding the first fence.
+_JSON_BLOCK = re.compile(r"```json\n(.*)\n```", re.DOTALL)
+
+# JSON value starting at the beginning of a line
+_JSON_START = re.compile(r"(?:\A|\n)[ \t]*([\[{])")
+
+# Characters that change the scanner state, outside and inside of strings
+_OUTSIDE_STRING = re.compile(r"[\"'\[\]{}]")
+_IN_STRING = {
+    '"': re.compile(r'["\\]'),
+    "'": re.compile(r"['\"\\]"),
+}
+
+_CLOSING = {"{": "}", "[": "]"}
+
 
 def setup_logging(logger=None):
     """
@@ -39,13 +59,215 @@ def markdownify(html: str) -> str:
     return _markdownify(html, heading_style="ATX").strip()
 
 
+def _json_block(response: str) -> str | None:
+    """
+    Contents of the first ```json markdown code block.
+    """
+    start = response.find("```json")
+    if start == -1:
+        return None
+
+    start = response.find("\n", start) + 1
+    end = response.find("```", start)
+    return response[start:end if end != -1 else None].strip() if start else None
+
+
+def _repair_json_match(match: re.Match) -> str:
+    double_quoted, single_quoted, closing = match.groups()
+    if double_quoted is not None:
+        return double_quoted
+    if single_quoted is not None:
+        return '"' + single_quoted.replace("\\'", "'").replace('"', '\\"') + '"'
+    return closing
+
+
 def parse_bot_response(response: str) -> Dict | List:
     """
     Parses the response from the bot.
+
+    Valid JSON in a code block is parsed directly, and JSON with single quotes or trailing commas is repaired in
+    one pass. Anything else, like truncated output, is parsed with :class:`JsonObjectStream`.
     """
     # Get data from md response block
-    match = re.split(r"```json\n(.*)\n```", response, flags=re.MULTILINE | re.DOTALL)
-    logger.debug("Match: %r", match)
-    text = match[1]
-    data = json.loads(text)
-    return data
+    if (match := _JSON_BLOCK.search(response)) is not None:
+        try:
+            return json.loads(match[1])
+        except json.JSONDecodeError:
+            pass
+
+    # Repair the first block, which may be unterminated
+    if (text := _json_block(response)) is not None:
+        try:
+            return json.loads(_JSON_REPAIR.sub(_repair_json_match, text), strict=False)
+        except json.JSONDecodeError as e:
+            logger.debug("Failed to repair response, parsing what there is: %r", e)
+
+    parser = JsonObjectStream()
+    parser.feed(response)
+    return parser.result()
+
+
+class JsonObjectStream:
+    """
+    Incrementally extract JSON objects from a streamed bot response.
+
+    JSON is expected to start with `[` or `{` at the beginning of a line, like in a markdown code block. Objects in
+    the top-level array are returned as soon as their closing brace arrives; a top-level object is returned once
+    complete.
+
+    The prompts ask for single quoted keys, so the text is normalized while scanning: single quoted strings are
+    converted to double quoted ones, and trailing commas are dropped.
+    """
+
+    def __init__(self):
+        self.objects: List[Dict] = []
+        self._object: List[str] = []
+        self._stack: List[str] = []
+        self._emit_depth = 0
+        self._quote = None
+        self._escape = False
+        self._line_start = True
+        self._started = False
+        self._done = False
+
+    def feed(self, chunk: str) -> List[Dict]:
+        """
+        Feed more of the response. Returns the objects completed by this chunk.
+        """
+        completed = []
+        pos = 0
+
+        if not self._started:
+            pos = self._find_start(chunk)
+            if pos is None:
+                return completed
+
+        while pos < len(chunk) and not self._done:
+            if self._escape:
+                # `\'` is not a valid JSON escape
+                self._emit(chunk[pos] if chunk[pos] == "'" else "\\" + chunk[pos])
+                self._escape = False
+                pos += 1
+                continue
+
+            pattern = _IN_STRING[self._quote] if self._quote else _OUTSIDE_STRING
+            match = pattern.search(chunk, pos)
+            end = match.start() if match else len(chunk)
+            if end > pos:
+                self._emit(chunk[pos:end])
+            if not match:
+                break
+
+            pos = end + 1
+            char = match.group()
+            if self._quote:
+                if char == "\\":
+                    self._escape = True
+                elif char == self._quote:
+                    self._quote = None
+                    self._emit('"')
+                else:
+                    # Double quote inside single quoted string
+                    self._emit('\\"')
+            elif char in "\"'":
+                self._quote = char
+                self._emit('"')
+            elif char in "[{":
+                self._stack.append(char)
+                if len(self._stack) == self._emit_depth + 1:
+                    self._object = []
+                self._emit(char)
+            else:
+                self._strip_trailing_comma()
+                self._emit(char)
+                if self._stack:
+                    self._stack.pop()
+
+                if char == "}" and len(self._stack) == self._emit_depth:
+                    if (obj := self._parse_object("".join(self._object))) is not None:
+                        completed.append(obj)
+                    self._object = []
+                if not self._stack:
+                    self._done = True
+
+        self.objects += completed
+        return completed
+
+    def result(self) -> Dict | List[Dict]:
+        """
+        Parsed response: the list of complete objects in the top-level array, or the top-level object.
+
+        A truncated top-level object is closed and parsed as far as it goes.
+        """
+        if not self._started:
+            raise ValueError("No JSON found in response")
+
+        if self._emit_depth == 1:
+            return self.objects
+
+        if self.objects:
+            return self.objects[0]
+
+        if not self._done and (obj := self._parse_object(self._close_partial())) is not None:
+            return obj
+
+        raise ValueError("Incomplete JSON object in response")
+
+    def _find_start(self, chunk: str) -> int | None:
+        """
+        Find where JSON starts in the chunk, and track line starts across chunks.
+        """
+        if self._line_start and (match := re.match(r"[ \t]*([\[{])", chunk)):
+            start = match.start(1)
+        elif match := _JSON_START.search(chunk):
+            start = match.start(1)
+        else:
+            last_line = chunk.rsplit("\n", 1)
+            self._line_start = (len(last_line) == 2 or self._line_start) and not last_line[-1].strip()
+            return None
+
+        self._started = True
+        self._emit_depth = 1 if chunk[start] == "[" else 0
+        return start
+
+    def _emit(self, text: str):
+        if len(self._stack) > self._emit_depth:
+            self._object.append(text)
+
+    def _strip_trailing_comma(self):
+        while self._object:
+            piece = self._object[-1].rstrip()
+            if piece.endswith(","):
+                self._object[-1] = piece[:-1]
+                return
+            if piece:
+                self._object[-1] = piece
+                return
+            self._object.pop()
+
+    def _close_partial(self) -> str:
+        text = "".join(self._object)
+        if self._quote:
+            text += '"'
+
+        text = text.rstrip().removesuffix(",")
+        if text.endswith(":"):
+            text += " null"
+
+        return text + "".join(_CLOSING[c] for c in reversed(self._stack))
+
+    def _parse_object(self, text: str) -> Dict | None:
+        try:
+            return json.loads(text, strict=False)
+        except json.JSONDecodeError:
+            pass
+
+        # Python literals, like `True` and `None`
+        try:
+            obj = ast.literal_eval(text)
+            if isinstance(obj, dict):
+                return obj
+        except (SyntaxError, ValueError) as e:
+            logger.debug("Failed to parse object %r: %r", text, e)
+
+        return None
@@ -0,0 +1,144 @@
+"""
+Persistent store of Wikipedia pages and their parsed sections.
+
+Pages are keyed by ``(lang, pageid, revid)``, and hold the page text along with the already-split sections, so an
+unchanged page is neither downloaded nor parsed again. Latest revision IDs are checked with batched MediaWiki API
+queries, one request per 50 titles.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple
+
+from platformdirs import user_data_dir
+from wikipedia.wikipedia import USER_AGENT
+
+from . import http_client
+
+logger = logging.getLogger(__name__)
+
+# Path to the page store database
+WIKI_DB = Path(user_data_dir("klikinsaastaja-ng"), "wikipedia.db")
+
+# MediaWiki API limit of titles per query
+TITLES_PER_QUERY = 50
+
+
+class Revision(NamedTuple):
+    pageid: int
+    revid: int
+
+
+class StoredPage(NamedTuple):
+    lang: str
+    pageid: int
+    revid: int
+    title: str
+    content: str
+    sections: List[Dict]
+
+
+def latest_revisions(lang: str, titles: Iterable[str]) -> Dict[str, Revision]:
+    """
+    Page and latest revision IDs of the page `titles`, following redirects. Missing pages are left out.
+    """
+    titles = list(dict.fromkeys(titles))
+    revisions = {}
+    for i in range(0, len(titles), TITLES_PER_QUERY):
+        batch = titles[i:i + TITLES_PER_QUERY]
+        response = http_client.session().get(
+            f"https://{lang}.wikipedia.org/w/api.php",
+            params={
+                "action": "query",
+                "prop": "info",
+                "titles": "|".join(batch),
+                "redirects": 1,
+                "format": "json",
+                "formatversion": 2,
+            },
+            headers={"User-Agent": USER_AGENT},
+        )
+        response.raise_for_status()
+        query = response.json().get("query", {})
+
+        # Resolve the requested titles through normalization and redirects
+        normalized = {item["from"]: item["to"] for item in query.get("normalized", [])}
+        redirects = {item["from"]: item["to"] for item in query.get("redirects", [])}
+        pages = {page["title"]: page for page in query.get("pages", []) if not page.get("missing")}
+        for title in batch:
+            resolved = normalized.get(title, title)
+            if page := pages.get(redirects.get(resolved, resolved)):
+                revisions[title] = Revision(page["pageid"], page["lastrevid"])
+
+    return revisions
+
+
+class WikipediaStore:
+    """
+    SQLite store of Wikipedia pages. Only the latest stored revision of a page is kept.
+    """
+
+    def __init__(self, path: Path = WIKI_DB):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.stats = Counter(hits=0, misses=0)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                lang TEXT NOT NULL,
+                pageid INTEGER NOT NULL,
+                revid INTEGER NOT NULL,
+                title TEXT NOT NULL,
+                content TEXT NOT NULL,
+                sections TEXT NOT NULL,
+                stored REAL NOT NULL,
+                PRIMARY KEY (lang, pageid)
+            ) WITHOUT ROWID
+        """)
+
+    def get_many(self, lang: str, revisions: Iterable[Revision]) -> Dict[int, StoredPage]:
+        """
+        Stored pages matching the revisions exactly, by page ID.
+        """
+        wanted = {revision.pageid: revision.revid for revision in revisions}
+        if not wanted:
+            return {}
+
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT lang, pageid, revid, title, content, sections FROM pages"
+                f" WHERE lang = ? AND pageid IN ({','.join('?' * len(wanted))})",
+                (lang, *wanted),
+            ).fetchall()
+
+        pages = {row[1]: StoredPage(*row[:5], json.loads(row[5])) for row in rows if wanted[row[1]] == row[2]}
+        self.stats["hits"] += len(pages)
+        self.stats["misses"] += len(wanted) - len(pages)
+        return pages
+
+    def put(self, lang: str, pageid: int, revid: int, title: str, content: str, sections: List[Dict]):
+        """
+        Store page revision and its sections, replacing the previously stored revision.
+
+        :param sections: JSON serializable section documents, like ``{"page_content": ..., "metadata": ...}``.
+        """
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (lang, pageid, revid, title, content, json.dumps(sections, ensure_ascii=False), time.time()),
+            )
+
+
+@lru_cache(maxsize=None)
+def wikipedia_store() -> WikipediaStore:
+    """
+    Shared :class:`WikipediaStore` instance.
+    """
+    return WikipediaStore()
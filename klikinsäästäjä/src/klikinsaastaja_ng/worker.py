@@ -0,0 +1,353 @@
+"""
+Long-running worker that rewrites article titles from a persistent job queue.
+
+Articles go through three stages, each with its own concurrency limit:
+
+1. ``fetch``: download and parse the article, filling the article cache.
+2. ``prompt``: render the prompt and compact the article context.
+3. ``llm``: ask the chatbot and parse the suggestion.
+
+Jobs are stored in SQLite, so queued and half-processed articles survive restarts. A failed stage is retried with
+exponential backoff, and after `max_attempts` failures the job is dead-lettered with the last error.
+"""
+
+import asyncio
+import inspect
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from enum import Enum
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple
+
+from platformdirs import user_data_dir
+
+from .bot import async_invoke_bot
+from .main import PromptFiles
+from .models import Href
+from .outlet import _prompt_and_context, outlet
+from .settings import settings
+from .utils import parse_bot_response
+
+logger = logging.getLogger(__name__)
+
+# Path to the job queue database
+JOBS_DB = Path(user_data_dir("klikinsaastaja-ng"), "jobs.db")
+
+
+class Stage(str, Enum):
+    FETCH = "fetch"
+    PROMPT = "prompt"
+    LLM = "llm"
+    DONE = "done"
+
+
+class State(str, Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    DEAD = "dead"
+
+
+class Job(NamedTuple):
+    id: int
+    url: str
+    title: str
+    stage: Stage
+    attempts: int
+    payload: Dict
+
+
+class JobQueue:
+    """
+    SQLite backed job queue. Jobs are unique by URL, so an article is processed only once.
+    """
+
+    def __init__(self, path: Path = JOBS_DB):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                url TEXT NOT NULL UNIQUE,
+                title TEXT,
+                stage TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available REAL NOT NULL,
+                payload TEXT NOT NULL DEFAULT '{}',
+                error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (stage, state, available)")
+        self._listeners: List[asyncio.Event] = []
+
+    def listen(self) -> asyncio.Event:
+        """
+        Event that is set whenever a job becomes pending. The listener clears it.
+        """
+        event = asyncio.Event()
+        self._listeners.append(event)
+        return event
+
+    def _notify(self):
+        for event in self._listeners:
+            event.set()
+
+    async def put(self, item: Href):
+        """
+        Add article to the queue, unless it has been queued before.
+        """
+        now = time.time()
+        with self._lock:
+            inserted = self._db.execute(
+                "INSERT OR IGNORE INTO jobs (url, title, stage, state, available, created, updated)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (str(item.url), item.title, Stage.FETCH.value, State.PENDING.value, now, now, now),
+            ).rowcount
+        if inserted:
+            self._notify()
+
+    def recover(self) -> int:
+        """
+        Return jobs left running by an interrupted worker to the queue.
+        """
+        with self._lock:
+            return self._db.execute(
+                "UPDATE jobs SET state = ?, updated = ? WHERE state = ?",
+                (State.PENDING.value, time.time(), State.RUNNING.value),
+            ).rowcount
+
+    def claim(self, stage: Stage, limit: int) -> List[Job]:
+        """
+        Take up to `limit` due jobs of `stage`, oldest first, and mark them running.
+        """
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            rows = self._db.execute(
+                "SELECT id, url, title, stage, attempts, payload FROM jobs"
+                " WHERE stage = ? AND state = ? AND available <= ? ORDER BY available LIMIT ?",
+                (stage.value, State.PENDING.value, now, limit),
+            ).fetchall()
+            self._db.executemany(
+                "UPDATE jobs SET state = ?, updated = ? WHERE id = ?",
+                ((State.RUNNING.value, now, row[0]) for row in rows),
+            )
+
+        return [Job(row[0], row[1], row[2], Stage(row[3]), row[4], json.loads(row[5])) for row in rows]
+
+    def next_due(self, stage: Stage) -> float | None:
+        """
+        Time the next pending job of `stage` becomes available.
+        """
+        with self._lock:
+            return self._db.execute(
+                "SELECT MIN(available) FROM jobs WHERE stage = ? AND state = ?", (stage.value, State.PENDING.value)
+            ).fetchone()[0]
+
+    def advance(self, job: Job, stage: Stage, payload: Dict):
+        state = State.DONE if stage == Stage.DONE else State.PENDING
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET stage = ?, state = ?, attempts = 0, available = ?, payload = ?, error = NULL,"
+                " updated = ? WHERE id = ?",
+                (stage.value, state.value, now, json.dumps(payload, default=str), now, job.id),
+            )
+        self._notify()
+
+    def retry(self, job: Job, error: str, delay: float):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET state = ?, attempts = attempts + 1, available = ?, error = ?, updated = ?"
+                " WHERE id = ?",
+                (State.PENDING.value, now + delay, error, now, job.id),
+            )
+        self._notify()
+
+    def release(self, job: Job):
+        """
+        Return unfinished job to the queue without counting it as an attempt.
+        """
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET state = ?, updated = ? WHERE id = ?", (State.PENDING.value, time.time(), job.id)
+            )
+
+    def dead_letter(self, job: Job, error: str):
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET state = ?, attempts = attempts + 1, error = ?, updated = ? WHERE id = ?",
+                (State.DEAD.value, error, time.time(), job.id),
+            )
+
+    def counts(self) -> Dict[str, int]:
+        """
+        Number of jobs per stage and state, like ``{"fetch/pending": 3}``.
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT stage, state, COUNT(*) FROM jobs GROUP BY stage, state").fetchall()
+        return {f"{stage}/{state}": count for stage, state, count in rows}
+
+
+ResultHandler = Callable[[Job, Dict, Dict], Any | Awaitable[Any]]
+
+
+class Worker:
+    """
+    Run the fetch, prompt and LLM stages over the jobs in `queue`.
+
+    :param prompt: The prompt to use. Can be a string or a PromptFiles enum value
+    :param on_result: Called with the job, its payload and the parsed chatbot suggestion when a job completes.
+        Synchronous handlers are run in a thread, so they don't block the event loop.
+    :param concurrency: Concurrent jobs per stage. Defaults come from settings.
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        prompt: str | PromptFiles,
+        on_result: ResultHandler = None,
+        concurrency: Dict[Stage, int] = None,
+        locale: str = "fi-FI",
+        max_attempts: int = None,
+        backoff: float = None,
+    ):
+        self.queue = queue
+        self.prompt = prompt
+        self.on_result = on_result
+        self.locale = locale
+        self.concurrency = {
+            Stage.FETCH: settings.worker_fetch_concurrency,
+            Stage.PROMPT: settings.worker_prompt_concurrency,
+            Stage.LLM: settings.chatbot_pool_size,
+            **(concurrency or {}),
+        }
+        self.max_attempts = settings.worker_max_attempts if max_attempts is None else max_attempts
+        self.backoff = settings.worker_backoff if backoff is None else backoff
+        self.stats = Counter()
+
+        self._stopping = asyncio.Event()
+        self._handlers = {Stage.FETCH: self._fetch, Stage.PROMPT: self._prompt, Stage.LLM: self._llm}
+        self._running: Dict[Stage, set] = {stage: set() for stage in self._handlers}
+
+    async def _fetch(self, job: Job) -> Dict:
+        article = await outlet(job.url).aget(job.url, locale=self.locale)
+        return {
+            "url": article.url,
+            "original_url": job.url,
+            "original_title": article.title or job.title,
+            "published": article.publish_date.isoformat() if isinstance(article.publish_date, datetime) else None,
+        }
+
+    async def _prompt(self, job: Job) -> Dict:
+        # Served from the article cache filled by the fetch stage
+        article = await outlet(job.url).aget(job.url, locale=self.locale)
+        prompt, context = await asyncio.to_thread(_prompt_and_context, article, self.prompt)
+        return {**job.payload, "prompt": prompt, "context": context}
+
+    async def _llm(self, job: Job) -> Dict:
+        response = await async_invoke_bot(job.payload["prompt"], job.payload["context"], locale=self.locale)
+        suggestion = parse_bot_response(response)
+        if inspect.iscoroutinefunction(self.on_result):
+            await self.on_result(job, job.payload, suggestion)
+        elif self.on_result is not None:
+            # Synchronous handlers may block, like saving into a database
+            result = await asyncio.to_thread(self.on_result, job, job.payload, suggestion)
+            if inspect.isawaitable(result):
+                await result
+        return {**job.payload, "suggestion": suggestion}
+
+    async def _process(self, stage: Stage, job: Job):
+        next_stage = list(Stage)[list(Stage).index(stage) + 1]
+        try:
+            payload = await self._handlers[stage](job)
+        except asyncio.CancelledError:
+            self.queue.release(job)
+            raise
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if job.attempts + 1 >= self.max_attempts:
+                logger.error("Job %r failed at %s, dead-lettering: %s", job.url, stage.value, error)
+                self.queue.dead_letter(job, error)
+                self.stats["dead"] += 1
+            else:
+                delay = self.backoff * 2 ** job.attempts
+                logger.warning("Job %r failed at %s, retrying in %.0f s: %s", job.url, stage.value, delay, error)
+                self.queue.retry(job, error, delay)
+                self.stats["retries"] += 1
+            return
+
+        self.queue.advance(job, next_stage, payload)
+        self.stats[stage.value] += 1
+        logger.debug("Job %r finished %s", job.url, stage.value)
+
+    async def _run_stage(self, stage: Stage):
+        running = self._running[stage]
+        changed = self.queue.listen()
+        while not self._stopping.is_set():
+            changed.clear()
+            free = self.concurrency[stage] - len(running)
+            jobs = self.queue.claim(stage, free) if free > 0 else []
+            for job in jobs:
+                task = asyncio.create_task(self._process(stage, job))
+                running.add(task)
+                task.add_done_callback(running.discard)
+
+            if jobs:
+                continue
+
+            # Sleep until something changes in the queue, a slot frees up or a retry becomes due
+            timeout = settings.worker_poll_interval
+            if free > 0 and (due := self.queue.next_due(stage)) is not None:
+                timeout = min(timeout, max(0.0, due - time.time()))
+
+            waiters = [asyncio.ensure_future(changed.wait()), asyncio.ensure_future(self._stopping.wait())]
+            if free <= 0:
+                waiters.append(asyncio.ensure_future(asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)))
+            await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for waiter in waiters:
+                waiter.cancel()
+
+    async def run(self):
+        """
+        Process jobs until :meth:`stop` is called. Jobs in progress are given `settings.worker_shutdown_timeout`
+        seconds to finish, and the rest are returned to the queue.
+        """
+        if recovered := self.queue.recover():
+            logger.info("Recovered %d interrupted jobs", recovered)
+
+        await asyncio.gather(*(self._run_stage(stage) for stage in self._handlers))
+
+        running = set().union(*self._running.values())
+        if running:
+            logger.info("Waiting for %d jobs to finish", len(running))
+            _, pending = await asyncio.wait(running, timeout=settings.worker_shutdown_timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        logger.info("Worker stopped: %r", self.metrics())
+
+    def stop(self):
+        """
+        Stop claiming new jobs. Safe to call from a signal handler.
+        """
+        self._stopping.set()
+
+    def metrics(self) -> Dict:
+        return {
+            **self.stats,
+            **{f"{stage.value}_running": len(tasks) for stage, tasks in self._running.items()},
+            **self.queue.counts(),
+        }
@@ -8,24 +8,84 @@ TODO: Make into context aware splitter
 """
 
 import getpass
+import hashlib
+import json
 import logging
 import os
-from typing import Any, Dict, List, Optional, Set, Tuple
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 from dotenv import load_dotenv
 import keyring
 from langchain_core.documents import Document
+from platformdirs import user_data_dir
 
 from langchain_community.vectorstores.chroma import Chroma
-#from langchain_community.embeddings import GPT4AllEmbeddings
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.embeddings import HuggingFaceEmbeddings
 
 from langchain_community.utilities import WikipediaAPIWrapper as _WikipediaAPIWrapper
+from langchain_community.utilities.wikipedia import WIKIPEDIA_MAX_QUERY_LENGTH
 
 import mwparserfromhell
+from mwparserfromhell.nodes import Heading
+
+from klikinsaastaja_ng.embeddings import embeddings
+from klikinsaastaja_ng.wiki_store import StoredPage, latest_revisions, wikipedia_store
 
 logger = logging.getLogger(__name__)
 
+# Path to the persistent vector store
+CHROMA_DIR = os.path.join(user_data_dir("klikinsaastaja-ng"), "chroma")
+
+# Documents per embedding call when indexing
+INDEX_BATCH_SIZE = 64
+
+# Maximum IDs or sources per vector store lookup
+LOOKUP_BATCH_SIZE = 500
+
+
+def document_id(doc: Document) -> str:
+    """
+    Content hash of the document text and metadata, used as its ID in the vector store.
+    """
+    payload = json.dumps([doc.page_content, doc.metadata], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def index_documents(db: Chroma, docs: Iterable[Document], batch_size: int = INDEX_BATCH_SIZE) -> Dict[str, int]:
+    """
+    Add documents into the vector store, embedding only the ones not already in it.
+
+    Documents are stored under their content hash, so unchanged sections are found by ID and skipped. Stored
+    documents of the same `source` pages that are no longer present, like sections of an older page revision, are
+    deleted.
+
+    :return: Number of added, skipped and deleted documents.
+    """
+    docs = {document_id(doc): doc for doc in docs}
+    ids = list(docs)
+
+    existing = set()
+    for i in range(0, len(ids), LOOKUP_BATCH_SIZE):
+        existing.update(db.get(ids=ids[i:i + LOOKUP_BATCH_SIZE], include=[])["ids"])
+
+    new = [doc_id for doc_id in ids if doc_id not in existing]
+    for i in range(0, len(new), batch_size):
+        batch = new[i:i + batch_size]
+        db.add_documents([docs[doc_id] for doc_id in batch], ids=batch)
+
+    sources = list({doc.metadata["source"] for doc in docs.values() if "source" in doc.metadata})
+    stale = []
+    for i in range(0, len(sources), LOOKUP_BATCH_SIZE):
+        stored = db.get(where={"source": {"$in": sources[i:i + LOOKUP_BATCH_SIZE]}}, include=[])["ids"]
+        stale += [doc_id for doc_id in stored if doc_id not in docs]
+    if stale:
+        db.delete(ids=stale)
+
+    counts = {"added": len(new), "skipped": len(existing), "deleted": len(stale)}
+    logger.info("Indexed documents: %r", counts)
+    return counts
+
+
 class WikipediaAPIWrapper(_WikipediaAPIWrapper):
     SECTIONS_TO_IGNORE: Set = set(
         (
@@ -53,59 +113,63 @@ class WikipediaAPIWrapper(_WikipediaAPIWrapper):
         )
     )
 
+    # Concurrent searches and page fetches in :meth:`load_many`
+    max_workers: int = 8
+
     def _page_to_document(self, page_title: str, wiki_page: Any) -> Document:
-        # patch bigger content limit size for the document
-        original_max_chars = self.doc_content_chars_max
-        self.doc_content_chars_max = -1
+        # Use the complete content for the document. Not patching `doc_content_chars_max`, as pages are loaded in
+        # threads.
         doc = super()._page_to_document(page_title, wiki_page)
-        self.doc_content_chars_max = original_max_chars
+        doc.page_content = wiki_page.content
         return doc
 
-    def _subsections(
-        self, section: mwparserfromhell.wikicode.Wikicode, parent_tiles=List[str]
-    ) -> List[Tuple[List[str], str]]:
+    def _sections(self, wikicode: mwparserfromhell.wikicode.Wikicode, page_title: str) -> List[Tuple[List[str], str]]:
         """
-        From a Wikipedia section, return a flattened list of all nested subsections.
+        From a parsed Wikipedia page, return a flattened list of all sections and nested subsections.
 
-        Each subsection is a tuple, where:
+        Each section is a tuple, where:
         - the first element is a list of parent subtitles, starting with the page title
-        - the second element is the text of the subsection (but not any children)
-        """
-        headings = [str(h) for h in section.filter_headings()]
-        if not headings:
-            return []
-        title = headings[0]
-        cleaned_title = title.strip("=" + " ")
-        if cleaned_title in self.SECTIONS_TO_IGNORE:
-            logger.debug(f"Ignoring section {cleaned_title}")
-            return []
-
-        if len(headings) == 0:
-            logger.debug(f"No headings in section {cleaned_title}")
-            return []
+        - the second element is the text of the section (but not any children)
 
-        titles = parent_tiles + [cleaned_title]
-        full_text = str(section)
-        logger.debug(f"Found section {titles}, splitting body at {title}")
-        section_text = full_text.split(title)[1]
-
-        if len(headings) == 1:
-            logger.debug(f"Found section {titles}, no subsections")
-            # no subsections
-            return [(titles, section_text)]
-
-        # try:
-        #     section_text = section_text.split(headings[0])[1]
-        # except IndexError as e:
-        #     logger.debug(f"Failed to split section {titles} at {headings[0]}")
-        #     raise e
-        first_subtitle = headings[1]
-        section_text = section_text.split(first_subtitle)[0]
-        results = [(titles, section_text)]
-        for subsection in section.get_sections(levels=[len(titles) + 1]):
-            results.extend(self._subsections(subsection, titles))
-
-        return results
+        The page nodes are walked once. Sections start from level 2 headings, and subsections are followed only one
+        level at a time. Ignored sections are skipped along with their subsections.
+        """
+        sections = []
+        # Open headings as (level, titles, followed)
+        parents: List[Tuple[int, List[str], bool]] = []
+        # Text of the current section, None when it's not followed
+        text: List[str] | None = None
+
+        for node in wikicode.nodes:
+            if not isinstance(node, Heading):
+                if text is not None:
+                    text.append(str(node))
+                continue
+
+            while parents and parents[-1][0] >= node.level:
+                parents.pop()
+
+            if node.level == 2:
+                titles, followed = [page_title], True
+            elif parents and parents[-1][2] and parents[-1][0] == node.level - 1:
+                titles, followed = parents[-1][1], True
+            else:
+                titles, followed = [], False
+
+            cleaned_title = str(node).strip("=" + " ")
+            if followed and cleaned_title in self.SECTIONS_TO_IGNORE:
+                logger.debug(f"Ignoring section {cleaned_title}")
+                followed = False
+
+            titles = titles + [cleaned_title]
+            parents.append((node.level, titles, followed))
+
+            text = [] if followed else None
+            if followed:
+                logger.debug(f"Found section {titles}")
+                sections.append((titles, text))
+
+        return [(titles, "".join(parts)) for titles, parts in sections]
 
     def _split_into_sections(self, document: Document) -> List[str]:
         """From a Wikipedia :class:`Document`, return a list of documents, one for each section."""
@@ -126,32 +190,87 @@ class WikipediaAPIWrapper(_WikipediaAPIWrapper):
         )]
 
         # Format the section content
-        for section in parsed_text.get_sections(levels=[2]):
-            for subsection_title_parts, subsection_text in self._subsections(
-                section, [title]
-            ):
-                # Format the section content
-                section_content = ""
-                for i, subtitle in enumerate(subsection_title_parts):
-                    section_content += f"{'#' * (i + 1)} {subtitle}\n"
-                section_content += subsection_text
-
-                docs.append(Document(
-                    page_content=section_content.strip(),
-                    metadata={
-                        **document.metadata,
-                        **{"title": " > ".join(subsection_title_parts)},
-                    },
-                ))
+        for subsection_title_parts, subsection_text in self._sections(parsed_text, title):
+            # Format the section content
+            section_content = ""
+            for i, subtitle in enumerate(subsection_title_parts):
+                section_content += f"{'#' * (i + 1)} {subtitle}\n"
+            section_content += subsection_text
+
+            docs.append(Document(
+                page_content=section_content.strip(),
+                metadata={
+                    **document.metadata,
+                    **{"title": " > ".join(subsection_title_parts)},
+                },
+            ))
         return docs
 
-    def load(self, query: str) -> List[Document]:
-        docs = []
-        for page in super().load(query):
-            logger.debug(f"Loading page {page.metadata['title']}")
-            docs += self._split_into_sections(page)
+    def _search(self, query: str) -> List[str]:
+        return self.wiki_client.search(query[:WIKIPEDIA_MAX_QUERY_LENGTH], results=self.top_k_results)[
+            : self.top_k_results
+        ]
+
+    def _load_page(self, page_title: str) -> List[Document]:
+        if not (wiki_page := self._fetch_page(page_title)):
+            return []
+        logger.debug(f"Loading page {page_title}")
+        docs = self._split_into_sections(self._page_to_document(page_title, wiki_page))
+
+        wikipedia_store().put(
+            self.lang,
+            int(wiki_page.pageid),
+            int(wiki_page.revision_id),
+            page_title,
+            wiki_page.content,
+            [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in docs],
+        )
         return docs
 
+    @staticmethod
+    def _stored_documents(page: StoredPage) -> List[Document]:
+        return [Document(**section) for section in page.sections]
+
+    def load_many(self, queries: Iterable[str]) -> Dict[str, List[Document]]:
+        """
+        Search and load pages for multiple queries at once.
+
+        Identical queries are searched once, and a page found by several queries is fetched once. Latest revisions of
+        the found pages are checked in one batch, and pages already in the page store at that revision are neither
+        fetched nor parsed again. Searches and page fetches run concurrently in a pool of `max_workers` threads.
+
+        :return: Section documents per query, in the search result order.
+        """
+        queries = list(dict.fromkeys(queries))
+        started = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="wikipedia") as pool:
+            results = dict(zip(queries, pool.map(self._search, queries)))
+            titles = list(dict.fromkeys(title for page_titles in results.values() for title in page_titles))
+
+            revisions = latest_revisions(self.lang, titles)
+            stored = wikipedia_store().get_many(self.lang, revisions.values())
+            pages = {}
+            for title in titles:
+                if title not in revisions:
+                    # Page doesn't exist
+                    pages[title] = []
+                elif page := stored.get(revisions[title].pageid):
+                    pages[title] = self._stored_documents(page)
+            changed = [title for title in titles if title not in pages]
+            pages.update(zip(changed, pool.map(self._load_page, changed)))
+
+        logger.info(
+            "Loaded %d pages for %d queries in %.1f s, %d fetched",
+            len(pages), len(queries), time.monotonic() - started, len(changed),
+        )
+        return {
+            query: [doc for title in page_titles for doc in pages[title]] for query, page_titles in results.items()
+        }
+
+    def load(self, query: str) -> List[Document]:
+        return self.load_many([query])[query]
+
 
 if __name__ == "__main__":
     from rich.logging import RichHandler
@@ -166,24 +285,19 @@ if __name__ == "__main__":
     if "OPENAI_API_KEY" not in os.environ:
         os.environ['OPENAI_API_KEY'] = keyring.get_password("openai", getpass.getuser())
 
-    import requests_cache
-
-    requests_cache.install_cache("/tmp/test_cache")
-
     with open("sidosryhma.json") as fd:
-        import json
         data = json.load(fd)
 
     loader = WikipediaAPIWrapper(
         lang="en", load_all_available_meta=False
     )
 
-    # Process all topics
-    docs = []
-    for interest_group in data:
-        print(docs)
-        _d = loader.load(interest_group['wikipedia query'])
-        docs += _d
+    # Process all topics. Pages found by several groups share the same documents.
+    docs = list({
+        id(doc): doc
+        for group_docs in loader.load_many(interest_group['wikipedia query'] for interest_group in data).values()
+        for doc in group_docs
+    }.values())
 
     for d in docs:
         snippet = d.page_content[:120] + "..." if len(d.page_content) > 120 else d.page_content
@@ -191,12 +305,15 @@ if __name__ == "__main__":
         print(f"PAGE:\n{snippet}")
         print()
 
-    #embeddings = OpenAIEmbeddings()
-    #embeddings = SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
-    embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L12-v2")
+    # Embedder from settings. Each model gets its own collection, as the vectors aren't comparable.
+    embedder = embeddings()
+    db = Chroma(
+        collection_name="wikipedia-" + hashlib.sha256(embedder.name.encode("utf-8")).hexdigest()[:16],
+        embedding_function=embedder,
+        persist_directory=CHROMA_DIR,
+    )
+    index_documents(db, docs)
 
-    db = Chroma.from_documents(docs, embeddings, persist_directory="/tmp/chroma_test_db")
-    
     for interest_group in data:
         print({
             "wikipedia query": interest_group['wikipedia query'],
@@ -213,3 +330,5 @@ if __name__ == "__main__":
                 "page": snippet,
                 "score": score,
             })
+
+    logger.info("Embeddings: %r", embedder.metrics())